@@ -1,11 +1,13 @@
 import os
 import sys
 import threading
+import multiprocessing
 import webbrowser
 from PySide6.QtWidgets import (QApplication, QMainWindow, QSystemTrayIcon, 
                               QMenu, QStyle, QMessageBox, QDialog, QVBoxLayout, 
                               QHBoxLayout, QLabel, QLineEdit, QPushButton, 
-                              QGroupBox, QCheckBox, QStatusBar, QTextEdit)
+                              QGroupBox, QCheckBox, QStatusBar, QTextEdit,
+                              QComboBox, QSpinBox)
 from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QIcon, QAction
 import requests
@@ -27,7 +29,7 @@ class SettingsDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("设置")
         self.setModal(True)
-        self.resize(400, 250)
+        self.resize(400, 320)
         
         layout = QVBoxLayout()
         
@@ -78,6 +80,27 @@ class SettingsDialog(QDialog):
         port_warning.setStyleSheet("color: #ff6b6b; font-size: 10px;")
         server_layout.addWidget(port_warning)
         
+        # 服务器模式
+        mode_layout = QHBoxLayout()
+        mode_label = QLabel("服务器模式:")
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItem("生产模式 (waitress)", "waitress")
+        self.mode_combo.addItem("异步模式 (asyncio)", "asyncio")
+        self.mode_combo.addItem("开发模式 (Flask)", "development")
+        mode_layout.addWidget(mode_label)
+        mode_layout.addWidget(self.mode_combo)
+        server_layout.addLayout(mode_layout)
+        
+        # 请求线程数
+        threads_layout = QHBoxLayout()
+        threads_label = QLabel("请求线程数:")
+        self.threads_spin = QSpinBox()
+        self.threads_spin.setRange(1, 64)
+        self.threads_spin.setValue(8)
+        threads_layout.addWidget(threads_label)
+        threads_layout.addWidget(self.threads_spin)
+        server_layout.addLayout(threads_layout)
+        
         server_group.setLayout(server_layout)
         layout.addWidget(server_group)
         
@@ -142,13 +165,18 @@ class SettingsDialog(QDialog):
         return {
             "cache_dir": self.cache_edit.text(),
             "host": self.host_edit.text(),
-            "port": self.port_edit.text()
+            "port": self.port_edit.text(),
+            "server_mode": self.mode_combo.currentData(),
+            "server_threads": self.threads_spin.value()
         }
     
     def set_settings(self, settings):
         self.cache_edit.setText(settings.get("cache_dir", ""))
         self.host_edit.setText(settings.get("host", "127.0.0.1"))
         self.port_edit.setText(settings.get("port", "5000"))
+        index = self.mode_combo.findData(settings.get("server_mode", "waitress"))
+        self.mode_combo.setCurrentIndex(max(index, 0))
+        self.threads_spin.setValue(int(settings.get("server_threads", 8)))
         # 保存原始端口号用于比较
         self.original_port = settings.get("port", "5000")
 
@@ -185,7 +213,43 @@ class MusicMetadataApp(QMainWindow):
             "cache_dir": os.path.join(os.path.expanduser("~"), "MusicCache"),
             "host": "127.0.0.1",  # 固定为本地主机
             "port": "5000",
-            "minimize_to_tray": True
+            "minimize_to_tray": True,
+            "file_cleanup_time": 300,
+            "output_max_mb": 2048,
+            "output_reserve_mb": 64,
+            "registry_backend": "sqlite",
+            "job_workers": 4,
+            "job_queue_size": 32,
+            "batch_workers": 4,
+            "tag_processes": 0,
+            "tag_padding_kb": 64,
+            "cover_timeout": 30,
+            "cover_cache_memory_mb": 64,
+            "cover_cache_disk_mb": 256,
+            "cover_cache_ttl": 3600,
+            "cover_max_size": 0,
+            "cover_quality": 85,
+            "http_pool_hosts": 10,
+            "http_pool_size": 10,
+            "http_host_pool_sizes": {},
+            "http_connect_timeout": 10,
+            "http_read_timeout": 60,
+            "download_segments": 1,
+            "download_segment_min_mb": 16,
+            "download_retries": 3,
+            "source_cache_max_mb": 1024,
+            "output_cache_mb": 1024,
+            "output_cache_ttl": 86400,
+            "use_x_sendfile": False,
+            "server_mode": "waitress",
+            "server_workers": 1,
+            "server_threads": 8,
+            "drain_timeout": 30,
+            "async_max_connections": 1000,
+            "profile_threshold": 0,
+            "profile_sample_rate": 0,
+            "profile_keep": 20,
+            "profile_interval_ms": 5
         }
         
         if os.path.exists(config_path):
@@ -346,7 +410,7 @@ class MusicMetadataApp(QMainWindow):
             from server_main import run_server
             self.server_thread = threading.Thread(
                 target=run_server,
-                args=(self.settings["host"], int(self.settings["port"]), cache_dir),
+                args=(self.settings["host"], int(self.settings["port"]), cache_dir, self.settings),
                 daemon=True
             )
             self.server_thread.start()
@@ -370,16 +434,22 @@ class MusicMetadataApp(QMainWindow):
             # 发送关闭请求
             url = f"http://{self.settings['host']}:{self.settings['port']}/shutdown"
             requests.post(url, timeout=2)
-            self.statusBar().showMessage("服务器已停止")
-            self.centralWidget().append("服务器已停止")
+            self.statusBar().showMessage("服务器正在关闭，等待进行中的任务完成")
+            self.centralWidget().append("服务器正在关闭")
         except:
             self.statusBar().showMessage("停止服务器失败")
             self.centralWidget().append("停止服务器失败")
     
     def restart_server(self):
         self.stop_server()
-        # 等待一段时间后重启
-        QTimer.singleShot(1000, self.start_server)
+        # 等待服务器线程退出后重启
+        QTimer.singleShot(500, self.wait_and_start_server)
+    
+    def wait_and_start_server(self):
+        if self.server_thread and self.server_thread.is_alive():
+            QTimer.singleShot(500, self.wait_and_start_server)
+            return
+        self.start_server()
     
     def closeEvent(self, event):
         if self.settings.get("minimize_to_tray", True) and self.tray_icon:
@@ -396,11 +466,17 @@ class MusicMetadataApp(QMainWindow):
     
     def quit_application(self):
         self.stop_server()
+        # 等待进行中的任务完成
+        if self.server_thread and self.server_thread.is_alive():
+            self.server_thread.join(float(self.settings.get("drain_timeout", 30)) + 5)
         if self.tray_icon:
             self.tray_icon.hide()
         QApplication.quit()
 
 def main():
+    # 打包后写入标签的子进程需要
+    multiprocessing.freeze_support()
+    
     # 隐藏控制台窗口
     import ctypes
     if hasattr(ctypes, 'windll'):
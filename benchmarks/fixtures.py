@@ -0,0 +1,179 @@
+"""
+基准测试用的合成音频和封面文件
+只保证各格式的文件头能被mutagen识别并写入标签，音频数据本身为静音填充
+"""
+
+import io
+import struct
+
+from mutagen.id3 import ID3, TIT2, TPE1
+from mutagen.ogg import OggPage
+
+MP3_FRAME_SIZE = 417  # MPEG1 Layer3 128kbps 44.1kHz 单帧长度
+CHUNK_SIZE = 1024 * 1024
+_ZERO_CHUNK = bytes(CHUNK_SIZE)
+
+# 各生成函数按块产出文件内容，几百MB的文件也可以直接流式写入磁盘
+
+
+def _zeros(size):
+    while size > 0:
+        chunk = min(size, CHUNK_SIZE)
+        yield _ZERO_CHUNK if chunk == CHUNK_SIZE else bytes(chunk)
+        size -= chunk
+
+
+def iter_mp3(size, old_tags=False):
+    """指定大小的MP3，old_tags为True时附带一个旧的ID3标签"""
+    if old_tags:
+        tags = ID3()
+        tags.add(TIT2(encoding=3, text='旧标题'))
+        tags.add(TPE1(encoding=3, text='旧艺术家'))
+        buffer = io.BytesIO()
+        tags.save(buffer)
+        yield buffer.getvalue()
+    frame = b'\xff\xfb\x90\x64' + b'\x00' * (MP3_FRAME_SIZE - 4)
+    frames_per_chunk = CHUNK_SIZE // MP3_FRAME_SIZE
+    frames = max(1, size // MP3_FRAME_SIZE)
+    chunk = frame * frames_per_chunk
+    while frames > 0:
+        count = min(frames, frames_per_chunk)
+        yield chunk if count == frames_per_chunk else frame * count
+        frames -= count
+
+
+def iter_flac(size):
+    """指定大小的FLAC，只有STREAMINFO块"""
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    # 采样率44100、双声道、16位、总采样数10秒
+    packed = (44100 << 44) | (1 << 41) | (15 << 36) | 44100 * 10
+    streaminfo += packed.to_bytes(8, 'big') + b'\x00' * 16
+    block = bytes([0x80]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+    yield b'fLaC' + block + b'\xff\xf8'
+    yield from _zeros(size)
+
+
+def iter_wav(size):
+    """指定大小的PCM WAV"""
+    fmt = struct.pack('<HHIIHH', 1, 2, 44100, 44100 * 4, 4, 16)
+    header = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', size)
+    yield b'RIFF' + struct.pack('<I', len(header) + size) + header
+    yield from _zeros(size)
+
+
+def _extended80(value):
+    """AIFF采样率使用的80位扩展精度浮点数（仅支持2的15次方以内的整数）"""
+    return struct.pack('>HQ', 16383 + 15, int(value) << (63 - 15))
+
+
+def iter_aiff(size):
+    """指定大小的AIFF"""
+    comm = struct.pack('>hIh', 2, size // 4, 16) + _extended80(44100)
+    header = b'AIFF' + b'COMM' + struct.pack('>I', len(comm)) + comm
+    header += b'SSND' + struct.pack('>I', size + 8) + struct.pack('>II', 0, 0)
+    yield b'FORM' + struct.pack('>I', len(header) + size) + header
+    yield from _zeros(size)
+
+
+def iter_ogg(size):
+    """指定大小的Ogg Vorbis"""
+    ident = b'\x01vorbis' + struct.pack('<IBIiiiB', 0, 2, 44100, 0, 128000, 0, 0xb8) + b'\x01'
+    comment = b'\x03vorbis' + struct.pack('<I', 6) + b'bench.' + struct.pack('<I', 0) + b'\x01'
+    setup = b'\x05vorbis' + b'\x00' * 32
+
+    page = OggPage()
+    page.packets = [ident]
+    page.first = True
+    page.serial = 1
+    yield page.write()
+    page = OggPage()
+    page.packets = [comment, setup]
+    page.sequence = 1
+    page.serial = 1
+    yield page.write()
+
+    sequence, left = 2, size
+    while left > 0:
+        chunk = min(left, 4000)
+        left -= chunk
+        page = OggPage()
+        page.packets = [b'\x00' * chunk]
+        page.sequence = sequence
+        page.position = sequence * 1024
+        page.serial = 1
+        page.last = left <= 0
+        yield page.write()
+        sequence += 1
+
+
+def _atom(name, data):
+    return struct.pack('>I', 8 + len(data)) + name + data
+
+
+def iter_m4a(size):
+    """指定大小的M4A（AAC），moov在mdat之前"""
+    ftyp = _atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom')
+    mvhd = _atom(b'mvhd', b'\x00' * 4 + struct.pack('>IIII', 0, 0, 44100, 44100 * 10) + b'\x00' * 80)
+    mdhd = _atom(b'mdhd', b'\x00' * 4 + struct.pack('>IIII', 0, 0, 44100, 44100 * 10) + b'\x00' * 4)
+    hdlr = _atom(b'hdlr', b'\x00' * 8 + b'soun' + b'\x00' * 13)
+    esds = _atom(b'esds', b'\x00' * 4 + b'\x03\x19\x00\x00\x00\x04\x11\x40\x15\x00\x00\x00\x00\x01\xf4'
+                 b'\x00\x00\x01\xf4\x00\x05\x02\x12\x10\x06\x01\x02')
+    mp4a = _atom(b'mp4a', b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 8
+                 + struct.pack('>HHHHI', 2, 16, 0, 0, 44100 << 16) + esds)
+    stsd = _atom(b'stsd', b'\x00' * 4 + struct.pack('>I', 1) + mp4a)
+
+    def build_moov(offset):
+        stco = _atom(b'stco', b'\x00' * 4 + struct.pack('>II', 1, offset))
+        minf = _atom(b'minf', _atom(b'stbl', stsd + stco))
+        trak = _atom(b'trak', _atom(b'mdia', mdhd + hdlr + minf))
+        return _atom(b'moov', mvhd + trak)
+
+    # stco需要指向mdat数据的实际偏移，moov长度与偏移值无关，先按0计算长度
+    offset = len(ftyp) + len(build_moov(0)) + 8
+    yield ftyp + build_moov(offset) + struct.pack('>I', 8 + size) + b'mdat'
+    yield from _zeros(size)
+
+
+def make_cover(size, kind='jpeg'):
+    """生成约为指定大小的封面图片（只有合法的文件头和尾，中间为填充数据）"""
+    if kind == 'png':
+        header = b'\x89PNG\r\n\x1a\n'
+        ihdr = struct.pack('>IIBBBBB', 500, 500, 8, 2, 0, 0, 0)
+        header += struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr + b'\x00' * 4
+        return header + b'\x00' * max(0, size - len(header) - 12) + b'\x00\x00\x00\x00IEND\xaeB`\x82'
+    header = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    return header + b'\x00' * max(0, size - len(header) - 2) + b'\xff\xd9'
+
+
+# 格式名 -> (扩展名, 生成函数)
+FORMATS = {
+    'mp3': ('.mp3', iter_mp3),
+    'flac': ('.flac', iter_flac),
+    'ogg': ('.ogg', iter_ogg),
+    'm4a': ('.m4a', iter_m4a),
+    'wav': ('.wav', iter_wav),
+    'aiff': ('.aiff', iter_aiff),
+}
+
+
+def make_audio(name, size):
+    """在内存中生成指定格式和大小的音频"""
+    return b''.join(FORMATS[name][1](size))
+
+
+def write_audio(path, name, size):
+    """把指定格式和大小的音频流式写入文件"""
+    with open(path, 'wb') as f:
+        for chunk in FORMATS[name][1](size):
+            f.write(chunk)
+    return path
+
+
+def build_library(formats, audio_size, cover_size):
+    """生成上游要提供的文件集合，返回 {路径: 内容}"""
+    files = {}
+    for name in formats:
+        files[f'/audio/track{FORMATS[name][0]}'] = make_audio(name, audio_size)
+    if cover_size > 0:
+        files['/cover.jpg'] = make_cover(cover_size)
+    return files
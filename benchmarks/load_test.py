@@ -0,0 +1,463 @@
+"""
+端到端压测：启动本地替身上游和被测服务器，按并发档位驱动 /process-music 与 /download
+输出吞吐量、p50/p95/p99延迟和服务器峰值RSS（JSON），并可与保存的基线比较
+
+用法:
+    python benchmarks/load_test.py --concurrency 1,8,32 --requests 64 --output baseline.json
+    python benchmarks/load_test.py --baseline baseline.json --tolerance 0.15
+    python benchmarks/load_test.py --current result.json --baseline baseline.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from fixtures import FORMATS, build_library
+from upstream import StandInUpstream
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 在子进程中运行被测服务器，峰值RSS只统计服务器本身
+SERVER_BOOTSTRAP = (
+    "import json, sys\n"
+    "sys.path.insert(0, sys.argv[1])\n"
+    "import server_main\n"
+    "options = json.loads(sys.argv[2])\n"
+    "server_main.run_server(options['host'], options['port'], options['cache_dir'], options['settings'])\n"
+)
+
+# 压测默认关闭源文件缓存和输出缓存，测量完整处理流程；可用 --set 覆盖
+DEFAULT_SERVER_SETTINGS = {
+    'source_cache_max_mb': 0,
+    'output_cache_mb': 0,
+    'output_max_mb': 0,
+    'file_cleanup_time': 600,
+}
+
+# 比较时检查的指标：(结果中的路径, 数值越大越好)
+COMPARED_METRICS = [
+    ('throughput_rps', True),
+    ('total.p50', False),
+    ('total.p95', False),
+    ('total.p99', False),
+    ('peak_rss_mb', False),
+]
+
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def read_rss(pid):
+    """读取进程当前的常驻内存（字节），无法读取时返回None"""
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            # 多进程模式（gunicorn/标签进程池）下累加子进程
+            return process.memory_info().rss + sum(
+                child.memory_info().rss for child in process.children(recursive=True)
+            )
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler:
+    """后台定时采样服务器进程的RSS，记录每个并发档位的峰值"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = None
+        if self.pid is None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            rss = read_rss(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            if self._stop.wait(self.interval):
+                break
+
+
+class ServerProcess:
+    """在子进程中启动被测服务器，结束时通过 /shutdown 正常关闭"""
+
+    def __init__(self, server_mode, settings, verbose=False):
+        self.host = '127.0.0.1'
+        self.port = free_port(self.host)
+        self.cache_dir = tempfile.mkdtemp(prefix='metadata-bench-')
+        self.settings = dict(DEFAULT_SERVER_SETTINGS, server_mode=server_mode)
+        self.settings.update(settings)
+        self.verbose = verbose
+        self.process = None
+
+    @property
+    def target(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self, timeout=30):
+        options = {'host': self.host, 'port': self.port, 'cache_dir': self.cache_dir, 'settings': self.settings}
+        output = None if self.verbose else subprocess.DEVNULL
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', SERVER_BOOTSTRAP, ROOT_DIR, json.dumps(options)],
+            cwd=ROOT_DIR, stdout=output, stderr=output
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'服务器进程已退出，返回码 {self.process.returncode}')
+            try:
+                if requests.get(f'{self.target}/status', timeout=1).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError('等待服务器启动超时')
+
+    def stop(self, timeout=60):
+        if self.process and self.process.poll() is None:
+            try:
+                requests.post(f'{self.target}/shutdown', timeout=5)
+                self.process.wait(timeout)
+            except (requests.RequestException, subprocess.TimeoutExpired):
+                self.process.terminate()
+                self.process.wait()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def percentile(sorted_values, fraction):
+    """最近秩法计算百分位数"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None, 'max': None}
+    return {
+        'p50': round(percentile(values, 0.50) * 1000, 2),
+        'p95': round(percentile(values, 0.95) * 1000, 2),
+        'p99': round(percentile(values, 0.99) * 1000, 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+        'max': round(values[-1] * 1000, 2),
+    }
+
+
+class LoadGenerator:
+    """按给定并发发送请求：先 /process-music，再完整下载处理后的文件"""
+
+    def __init__(self, target, upstream, formats, cover, repeat=False, lyrics='', timeout=300):
+        self.target = target.rstrip('/')
+        self.upstream = upstream
+        self.formats = formats
+        self.cover = cover
+        self.repeat = repeat
+        self.lyrics = lyrics
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def payload(self, level, index):
+        extension = FORMATS[self.formats[index % len(self.formats)]][0]
+        # 默认每个请求的标题不同，避免合并请求和输出缓存掩盖处理开销
+        title = '压测曲目' if self.repeat else f'压测曲目 {level}-{index}'
+        payload = {
+            'url': self.upstream.url(f'/audio/track{extension}'),
+            'title': title,
+            'artist': '压测艺术家',
+            'album': '压测专辑',
+            'year': '2024',
+            'lyrics': self.lyrics,
+        }
+        if self.cover:
+            payload['cover_url'] = self.upstream.url('/cover.jpg')
+        return payload
+
+    def request(self, level, index):
+        session = self.session()
+        started = time.perf_counter()
+        try:
+            response = session.post(f'{self.target}/process-music', json=self.payload(level, index), timeout=self.timeout)
+            processed = time.perf_counter()
+            if response.status_code != 200:
+                return {'ok': False, 'status': response.status_code}
+            received = 0
+            with session.get(response.json()['download_url'], stream=True, timeout=self.timeout) as download:
+                for chunk in download.iter_content(64 * 1024):
+                    received += len(chunk)
+            finished = time.perf_counter()
+            if download.status_code != 200:
+                return {'ok': False, 'status': download.status_code}
+        except requests.RequestException as e:
+            return {'ok': False, 'status': type(e).__name__}
+        return {
+            'ok': True,
+            'process': processed - started,
+            'download': finished - processed,
+            'total': finished - started,
+            'bytes': received,
+        }
+
+    def run_level(self, concurrency, count, sampler):
+        with sampler, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            started = time.perf_counter()
+            results = list(executor.map(lambda index: self.request(concurrency, index), range(count)))
+            elapsed = time.perf_counter() - started
+
+        succeeded = [result for result in results if result['ok']]
+        errors = {}
+        for result in results:
+            if not result['ok']:
+                errors[str(result['status'])] = errors.get(str(result['status']), 0) + 1
+        return {
+            'concurrency': concurrency,
+            'requests': count,
+            'succeeded': len(succeeded),
+            'errors': errors,
+            'duration': round(elapsed, 3),
+            'throughput_rps': round(len(succeeded) / elapsed, 3) if elapsed > 0 else None,
+            'bytes_downloaded': sum(result['bytes'] for result in succeeded),
+            'process': summarize([result['process'] for result in succeeded]),
+            'download': summarize([result['download'] for result in succeeded]),
+            'total': summarize([result['total'] for result in succeeded]),
+            'peak_rss_mb': round(sampler.peak / 1024 / 1024, 1) if sampler.peak else None,
+        }
+
+
+def lookup(result, path):
+    value = result
+    for key in path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(current, baseline, tolerance):
+    """对比当前结果与基线，返回超出容差的退化项"""
+    baseline_levels = {result['concurrency']: result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        base = baseline_levels.get(result['concurrency'])
+        if base is None:
+            continue
+        for path, higher_is_better in COMPARED_METRICS:
+            now, before = lookup(result, path), lookup(base, path)
+            if not now or not before:
+                continue
+            change = (now - before) / before
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({
+                    'concurrency': result['concurrency'],
+                    'metric': path,
+                    'baseline': before,
+                    'current': now,
+                    'change': round(change, 4),
+                })
+        failed_now = result['requests'] - result['succeeded']
+        failed_before = base['requests'] - base['succeeded']
+        if failed_now > failed_before:
+            regressions.append({
+                'concurrency': result['concurrency'],
+                'metric': 'failed_requests',
+                'baseline': failed_before,
+                'current': failed_now,
+                'change': None,
+            })
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_settings(pairs):
+    """解析 --set key=value，值按JSON解析，失败时作为字符串"""
+    settings = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+    return settings
+
+
+def run_benchmark(args):
+    formats = args.formats.split(',')
+    for name in formats:
+        if name not in FORMATS:
+            raise SystemExit(f'未知格式: {name}')
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    upstream = StandInUpstream(
+        build_library(formats, args.audio_kb * 1024, args.cover_kb * 1024),
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_kbps * 1024,
+        etag=not args.no_etag,
+    ).start()
+
+    server = None
+    try:
+        if args.target:
+            target, pid = args.target, args.server_pid
+        else:
+            server = ServerProcess(args.server_mode, parse_settings(args.set), args.verbose).start()
+            target, pid = server.target, server.process.pid
+
+        generator = LoadGenerator(target, upstream, formats, args.cover_kb > 0, args.repeat, 'la' * (args.lyrics_chars // 2))
+        for index in range(args.warmup):
+            generator.request(0, index)
+
+        sampler = RssSampler(pid)
+        results = []
+        for level in levels:
+            result = generator.run_level(level, args.requests or level * 4, sampler)
+            results.append(result)
+            print(
+                f"并发 {level:>4}: {result['throughput_rps']} 请求/秒, "
+                f"p50 {result['total']['p50']}ms, p95 {result['total']['p95']}ms, p99 {result['total']['p99']}ms, "
+                f"峰值RSS {result['peak_rss_mb']}MB, 失败 {result['requests'] - result['succeeded']}",
+                file=sys.stderr
+            )
+    finally:
+        if server:
+            server.stop()
+        upstream.stop()
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server_mode': None if args.target else args.server_mode,
+            'formats': formats,
+            'audio_kb': args.audio_kb,
+            'cover_kb': args.cover_kb,
+            'lyrics_chars': args.lyrics_chars,
+            'latency_ms': args.latency_ms,
+            'bandwidth_kbps': args.bandwidth_kbps,
+            'repeat': args.repeat,
+            'settings': parse_settings(args.set),
+            'upstream_requests': upstream.requests,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='元数据处理服务器端到端压测')
+    parser.add_argument('--concurrency', default='1,4,16,64', help='并发档位，逗号分隔')
+    parser.add_argument('--requests', type=int, default=0, help='每个档位的请求数，默认为并发数的4倍')
+    parser.add_argument('--warmup', type=int, default=2, help='正式测量前的预热请求数')
+    parser.add_argument('--formats', default='mp3,flac,ogg,m4a,wav,aiff', help='轮流使用的音频格式')
+    parser.add_argument('--audio-kb', type=int, default=4096, help='合成音频文件大小（KB）')
+    parser.add_argument('--cover-kb', type=int, default=200, help='封面大小（KB），0表示不带封面')
+    parser.add_argument('--lyrics-chars', type=int, default=0, help='歌词长度（字符）')
+    parser.add_argument('--latency-ms', type=float, default=0, help='上游首字节延迟（毫秒）')
+    parser.add_argument('--bandwidth-kbps', type=int, default=0, help='上游每连接带宽（KB/秒），0表示不限制')
+    parser.add_argument('--no-etag', action='store_true', help='上游不返回ETag')
+    parser.add_argument('--repeat', action='store_true', help='所有请求使用相同的元数据（测量合并请求和缓存）')
+    parser.add_argument('--server-mode', default='waitress', help='被测服务器的运行模式')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='覆盖服务器配置项')
+    parser.add_argument('--target', help='压测已运行的服务器而不是启动新的子进程')
+    parser.add_argument('--server-pid', type=int, help='配合--target采样该进程的RSS')
+    parser.add_argument('--verbose', action='store_true', help='显示服务器输出')
+    parser.add_argument('--output', help='结果JSON文件，默认输出到标准输出')
+    parser.add_argument('--current', help='不运行压测，直接读取已有结果用于比较')
+    parser.add_argument('--baseline', help='与之比较的基线结果文件')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='允许的相对退化比例')
+    args = parser.parse_args()
+
+    if args.current:
+        with open(args.current, 'r', encoding='utf-8') as f:
+            report = json.load(f)
+    else:
+        report = run_benchmark(args)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        report['comparison'] = {
+            'baseline': args.baseline,
+            'tolerance': args.tolerance,
+            'regressions': compare(report, baseline, args.tolerance),
+        }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        regressions = report['comparison']['regressions']
+        for item in regressions:
+            print(
+                f"退化: 并发 {item['concurrency']} {item['metric']} {item['baseline']} -> {item['current']}",
+                file=sys.stderr
+            )
+        if regressions:
+            sys.exit(1)
+        print('未发现超出容差的退化', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
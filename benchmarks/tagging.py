@@ -0,0 +1,236 @@
+"""
+标签写入微基准：按格式测量 add_metadata_to_* 与 strip_existing_metadata 的开销
+变化维度为音频大小、封面大小、歌词长度，以及源文件是否已带有大标签
+每次调用报告耗时、读写字节数和读写系统调用次数，并标出整文件重写的情况
+
+用法:
+    python benchmarks/tagging.py --sizes-mb 1,10,100 --output tagging.json
+    python benchmarks/tagging.py --formats mp3,flac --sizes-mb 500 --cover-kb 0,2048 --repeat 1
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import mutagen
+
+from fixtures import FORMATS, make_cover, write_audio
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+import server_main  # noqa: E402
+
+# 格式名 -> server_main中的标签写入函数名
+TAGGERS = {
+    'mp3': 'add_metadata_to_mp3',
+    'flac': 'add_metadata_to_flac',
+    'ogg': 'add_metadata_to_ogg',
+    'm4a': 'add_metadata_to_mp4',
+    'wav': 'add_metadata_to_wav',
+    'aiff': 'add_metadata_to_aiff',
+}
+
+# 写入量超过音频数据大小的这个比例时视为整文件重写（音频数据被移动）
+REWRITE_RATIO = 0.5
+
+# “已带有大标签”的源文件：1MB封面和64K字符的歌词
+LARGE_TAGS = {
+    'title': '旧标题',
+    'artist': '旧艺术家',
+    'album': '旧专辑',
+    'year': '1999',
+    'lyrics': '旧' * 65536,
+    'tips': '旧注释',
+    'cover_data': make_cover(1024 * 1024),
+}
+
+
+def io_counters():
+    """读取当前进程累计的读写字节数和系统调用次数，无法读取时返回None"""
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+        except (psutil.Error, AttributeError):
+            return None
+        return {
+            'read_bytes': getattr(counters, 'read_chars', counters.read_bytes),
+            'written_bytes': getattr(counters, 'write_chars', counters.write_bytes),
+            'read_calls': counters.read_count,
+            'write_calls': counters.write_count,
+        }
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    return {
+        'read_bytes': int(values['rchar']),
+        'written_bytes': int(values['wchar']),
+        'read_calls': int(values['syscr']),
+        'write_calls': int(values['syscw']),
+    }
+
+
+def measure(function, path):
+    """调用一次函数，返回耗时和I/O计数的增量"""
+    before = io_counters()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    ok = function(path)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    after = io_counters()
+    # 读取/proc/self/io本身也会计入一次读调用，结果中的计数因此略有偏差
+    delta = {key: after[key] - before[key] for key in after} if before and after else {}
+    return ok, wall, cpu, delta
+
+
+def build_metadata(cover_size, lyrics_chars):
+    metadata = {
+        'title': '基准测试标题',
+        'artist': '基准测试艺术家',
+        'album': '基准测试专辑',
+        'year': '2024',
+        'lyrics': 'la' * (lyrics_chars // 2),
+        'tips': '',
+    }
+    if cover_size:
+        metadata['cover_data'] = make_cover(cover_size)
+    return metadata
+
+
+def prepare_source(work_dir, name, size, old_tags):
+    """生成一个源文件，old_tags为True时先写入大标签"""
+    path = os.path.join(work_dir, f"source_{size}_{int(old_tags)}{FORMATS[name][0]}")
+    write_audio(path, name, size)
+    if old_tags and not server_main.add_metadata_to_file(path, LARGE_TAGS):
+        raise RuntimeError(f'无法为{name}写入初始标签')
+    return path
+
+
+def run_case(source, work_path, function, repeat, audio_bytes):
+    """在源文件的副本上重复调用函数，复制不计入测量"""
+    timings, cpu_timings, delta, ok = [], [], {}, True
+    for _ in range(repeat):
+        shutil.copyfile(source, work_path)
+        success, wall, cpu, delta = measure(function, work_path)
+        ok = ok and bool(success)
+        timings.append(wall)
+        cpu_timings.append(cpu)
+    file_bytes = os.path.getsize(source)
+    written = delta.get('written_bytes')
+    return {
+        'ok': ok,
+        'file_bytes': file_bytes,
+        'output_bytes': os.path.getsize(work_path),
+        'wall_ms': {
+            'min': round(min(timings) * 1000, 3),
+            'median': round(statistics.median(timings) * 1000, 3),
+        },
+        'cpu_ms': round(statistics.median(cpu_timings) * 1000, 3),
+        **delta,
+        'rewrites_file': written >= audio_bytes * REWRITE_RATIO if written is not None else None,
+    }
+
+
+def run_benchmark(args):
+    formats = args.formats.split(',')
+    for name in formats:
+        if name not in FORMATS:
+            raise SystemExit(f'未知格式: {name}')
+    sizes = [int(float(size) * 1024 * 1024) for size in args.sizes_mb.split(',')]
+    cover_sizes = [int(size) * 1024 for size in args.cover_kb.split(',')]
+    lyrics_lengths = [int(length) for length in args.lyrics_chars.split(',')]
+    old_tags_options = {'both': [False, True], 'yes': [True], 'no': [False]}[args.old_tags]
+
+    work_dir = tempfile.mkdtemp(prefix='metadata-tagging-', dir=args.work_dir)
+    results = []
+    try:
+        for name, size, old_tags in itertools.product(formats, sizes, old_tags_options):
+            source = prepare_source(work_dir, name, size, old_tags)
+            work_path = os.path.join(work_dir, 'work' + FORMATS[name][0])
+            case = {'format': name, 'audio_bytes': size, 'old_tags': old_tags}
+
+            result = run_case(source, work_path, server_main.strip_existing_metadata, args.repeat, size)
+            results.append({**case, 'function': 'strip_existing_metadata', 'cover_bytes': None,
+                            'lyrics_chars': None, **result})
+            report(results[-1])
+
+            tagger = getattr(server_main, TAGGERS[name])
+            for cover_size, lyrics_chars in itertools.product(cover_sizes, lyrics_lengths):
+                metadata = build_metadata(cover_size, lyrics_chars)
+                result = run_case(source, work_path, lambda path: tagger(path, metadata), args.repeat, size)
+                results.append({**case, 'function': TAGGERS[name], 'cover_bytes': cover_size,
+                                'lyrics_chars': lyrics_chars, **result})
+                report(results[-1])
+            os.remove(source)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mutagen': mutagen.version_string,
+            'repeat': args.repeat,
+            'io_counters': 'psutil' if psutil is not None else ('/proc/self/io' if io_counters() else None),
+        },
+        'results': results,
+    }
+
+
+def report(result):
+    """在标准错误输出一行摘要"""
+    written = result.get('written_bytes')
+    print(
+        f"{result['function']:<26} {result['audio_bytes'] / 1024 / 1024:>7.1f}MB "
+        f"旧标签={'是' if result['old_tags'] else '否'} "
+        f"封面={'-' if result['cover_bytes'] is None else result['cover_bytes'] // 1024}KB "
+        f"歌词={'-' if result['lyrics_chars'] is None else result['lyrics_chars']} "
+        f"{result['wall_ms']['median']:>9.2f}ms "
+        f"写入={'?' if written is None else written} "
+        f"调用={result.get('read_calls', '?')}r/{result.get('write_calls', '?')}w"
+        f"{' 整文件重写' if result['rewrites_file'] else ''}{'' if result['ok'] else ' 失败'}",
+        file=sys.stderr
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='按格式测量标签写入的开销')
+    parser.add_argument('--formats', default='mp3,flac,ogg,m4a,wav,aiff', help='测试的格式，逗号分隔')
+    parser.add_argument('--sizes-mb', default='1,10,100', help='音频文件大小（MB），逗号分隔，最大可到500')
+    parser.add_argument('--cover-kb', default='0,1024', help='写入的封面大小（KB），逗号分隔')
+    parser.add_argument('--lyrics-chars', default='0,16384', help='写入的歌词长度（字符），逗号分隔')
+    parser.add_argument('--old-tags', choices=['both', 'yes', 'no'], default='both', help='源文件是否已带有大标签')
+    parser.add_argument('--repeat', type=int, default=3, help='每个组合的重复次数')
+    parser.add_argument('--work-dir', help='生成测试文件的目录，默认使用系统临时目录')
+    parser.add_argument('--output', help='结果JSON文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    # 不测量日志输出的开销
+    logging.disable(logging.INFO)
+    report_data = run_benchmark(args)
+
+    output = json.dumps(report_data, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+本地替身上游：在内存中提供合成的音频和封面文件
+可模拟首字节延迟和带宽限制，支持ETag条件请求和Range请求
+"""
+
+import hashlib
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        upstream = self.server.upstream
+        upstream.count_request()
+        path = self.path.split('?', 1)[0]
+        content = upstream.files.get(path)
+        if content is None:
+            self.send_error(404)
+            return
+
+        if upstream.latency > 0:
+            time.sleep(upstream.latency)
+
+        etag = upstream.etags[path]
+        if upstream.etag_enabled and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = 0, len(content) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(content)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if upstream.etag_enabled:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if send_body:
+            self.write_throttled(memoryview(content)[start:end + 1])
+
+    def write_throttled(self, body):
+        """按块写出，带宽限制下每块之后补足应耗费的时间"""
+        bandwidth = self.server.upstream.bandwidth
+        started = time.perf_counter()
+        sent = 0
+        try:
+            for offset in range(0, len(body), CHUNK_SIZE):
+                chunk = body[offset:offset + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if bandwidth > 0:
+                    delay = sent / bandwidth - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class UpstreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 高并发档位下避免listen队列溢出
+
+
+class StandInUpstream:
+    """在后台线程中运行的本地上游服务器"""
+
+    def __init__(self, files, latency=0.0, bandwidth=0, etag=True, host='127.0.0.1', port=0):
+        self.files = files
+        self.etags = {path: f'"{hashlib.sha1(content).hexdigest()}"' for path, content in files.items()}
+        self.latency = latency  # 秒
+        self.bandwidth = bandwidth  # 每个连接的字节/秒，0表示不限制
+        self.etag_enabled = etag
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.httpd = UpstreamServer((host, port), UpstreamHandler)
+        self.httpd.upstream = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def url(self, path):
+        return self.base_url + path
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,17 +1,20 @@
 import os
 import uuid
 import requests
-from flask import Flask, request, jsonify, send_file
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, jsonify, send_file, Response, g
 from flask_cors import CORS
+from werkzeug.serving import make_server, BaseWSGIServer
+from werkzeug.http import parse_range_header, parse_if_range_header
 from mutagen import File
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, TYER, USLT, APIC, TDRC, delete, COMM
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, TYER, USLT, APIC, TDRC, delete, COMM, ID3v1SaveOptions
 from mutagen.mp3 import MP3
-from mutagen.flac import FLAC
+from mutagen.flac import FLAC, Picture, VCFLACDict
 from mutagen.oggvorbis import OggVorbis
-from mutagen.mp4 import MP4
+from mutagen.mp4 import MP4, MP4Cover
 from mutagen.wave import WAVE
 from mutagen.aiff import AIFF
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 import tempfile
 import threading
 import time
@@ -21,34 +24,514 @@ import traceback
 import shutil
 import signal
 import atexit
+import json
+import hashlib
+import io
+import itertools
+import zipfile
+import heapq
+import sqlite3
+import sys
+import cProfile
+import pstats
+from contextlib import contextmanager
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import asyncio
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # 全局变量
 app = Flask(__name__)
 CORS(app)
 TEMP_DIR = tempfile.gettempdir()
 FILE_CLEANUP_TIME = 300  # 5分钟
-file_registry = {}
+OUTPUT_MAX_BYTES = 2048 * 1024 * 1024  # 已处理文件的磁盘配额，0表示不限制
+OUTPUT_RESERVE_BYTES = 64 * 1024 * 1024  # 每个处理中的任务预留的空间
+QUOTA_RETRY_AFTER = 30
+REGISTRY_BACKEND = 'sqlite'  # sqlite：保存在缓存目录，重启后保留；memory：只保存在内存中
+RESERVATION_MAX_AGE = 3600  # 超过此时间的预留视为崩溃进程遗留
+ORPHAN_GRACE_TIME = 600  # 未注册且超过此时间未修改的文件视为遗留文件
 is_shutting_down = False
+
+# 服务器
+SERVER_MODE = 'waitress'  # development：Flask内置服务器；waitress：多线程生产服务器；gunicorn：多进程（仅Linux/macOS）；asyncio：事件循环（需要aiohttp）
+SERVER_WORKERS = 1  # 工作进程数（仅gunicorn）
+SERVER_THREADS = 8  # 每个工作进程处理请求的线程数
+DRAIN_TIMEOUT = 30  # 关闭时等待进行中的任务完成的最长时间（秒）
+ASYNC_MAX_CONNECTIONS = 1000  # asyncio模式下同时进行的上游连接数上限
+wsgi_server = None  # 正在运行的服务器，用于关闭
+
+# 异步任务
+JOB_WORKERS = 4  # 工作线程数
+JOB_QUEUE_SIZE = 32  # 最多排队的任务数
+JOB_STAGES = ('download', 'cover', 'tagging')
+job_registry = {}
+job_lock = threading.Lock()
+job_executor = None
+
+# 相同请求合并处理
+inflight_requests = {}  # 请求指纹 -> 正在进行的处理
+inflight_lock = threading.Lock()
+coalesced_requests = 0  # 被合并的请求数
+
+# 批量处理
+BATCH_WORKERS = 4  # 批量处理的并行数
+MAX_BATCH_TRACKS = 100
+BATCH_SHARED_FIELDS = ('artist', 'album', 'year', 'cover_url', 'tips')
+batch_executor = None
+batch_executor_lock = threading.Lock()
+
+# 封面与音频并行下载
+COVER_TIMEOUT = 30  # 封面下载超时（秒）
+COVER_WORKERS = 8
+cover_executor = None
+cover_executor_lock = threading.Lock()
+
+# 写入标签的进程池：mutagen是纯Python实现，大文件写入标签时会长时间占用GIL
+TAG_PROCESSES = 0  # 进程数，0表示在请求线程中直接写入
+tag_pool = None
+tag_pool_lock = threading.Lock()
+
+# 标签区预留的填充空间：再次写入标签时新标签放得下就原地更新，不必移动音频数据
+TAG_PADDING = 64 * 1024  # 另加音频大小的1%
+tag_saves = {'in_place': 0, 'rewrite': 0}  # 原地更新与整文件重写的次数
+tag_pending = 0  # 已提交但未完成的写入任务数
+
+# 封面缓存
+COVER_CACHE_MEMORY_BYTES = 64 * 1024 * 1024  # 内存层容量，0表示不缓存
+COVER_CACHE_DISK_BYTES = 256 * 1024 * 1024  # 磁盘层容量，0表示只用内存
+COVER_CACHE_TTL = 3600  # 同一URL的封面缓存时间（秒）
+COVER_CACHE_MAX_URLS = 10000
+cover_cache = None
+
+# 封面规范化（需要Pillow）：缩小过大的封面并重新编码为JPEG
+COVER_MAX_SIZE = 0  # 最长边的像素数，0表示嵌入原图
+COVER_QUALITY = 85  # JPEG质量
+
+# 上游HTTP连接池
+HTTP_POOL_HOSTS = 10  # 缓存连接池的主机数
+HTTP_POOL_SIZE = 10  # 每个主机保持的连接数
+HTTP_HOST_POOL_SIZES = {}  # 指定主机的连接数，例如 {"cdn.example.com": 32}
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+
+# 分段并行下载：上游支持Range时用多个连接同时下载大文件的不同部分
+DOWNLOAD_SEGMENTS = 1  # 分段数，1表示单连接下载
+DOWNLOAD_SEGMENT_MIN_BYTES = 16 * 1024 * 1024  # 小于此大小的文件不分段
+DOWNLOAD_RETRIES = 3  # 每段中断后从断点继续的最大次数
+http_session = None
+http_session_lock = threading.Lock()
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_DOWNLOAD_RANGES = 16  # 单个请求最多的Range段数
+HTTP_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+DOWNLOAD_HEADERS = {
+    'Accept': '*/*',
+    'Accept-Encoding': 'identity'
+}
+
+# 源音频缓存
+SOURCE_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1GB，0表示不缓存
+source_cache = None
+
+# 处理结果缓存：相同的源文件内容和元数据直接返回之前的结果
+OUTPUT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1GB，0表示不缓存
+OUTPUT_CACHE_TTL = 24 * 3600  # 结果缓存有效期（秒），与下载链接的有效期无关
+output_cache = None
+
 logger = logging.getLogger(__name__)
 
-def download_file(url, file_path):
-    """下载文件到指定路径"""
+# 监控指标
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_FORMATS = {'mp3': 'mp3', 'flac': 'flac', 'ogg': 'ogg', 'oga': 'ogg', 'm4a': 'mp4', 'mp4': 'mp4',
+                  'wav': 'wav', 'aiff': 'aiff', 'aif': 'aiff', 'zip': 'zip'}
+METRIC_HELP = {
+    'metadata_stage_duration_seconds': '各处理阶段耗时：connect上游响应头、download下载音频、cover下载封面、resize缩小封面、strip解析并清除旧标签、tag写入标签、serve发送文件',
+    'metadata_bytes_in_total': '从上游下载的字节数',
+    'metadata_bytes_out_total': '发送给客户端的字节数',
+    'metadata_tracks_total': '处理的歌曲数',
+    'metadata_active_jobs': '排队和执行中的异步任务数',
+    'metadata_inflight_requests': '正在处理的请求数（相同请求合并计算）',
+    'metadata_coalesced_requests_total': '被合并处理的相同请求数',
+    'metadata_download_retries_total': '分段下载中断后从断点继续的次数',
+    'metadata_registry_files': '可下载的文件数',
+    'metadata_registry_bytes': '可下载的文件占用的磁盘空间',
+    'metadata_registry_reserved_bytes': '处理中任务预留的磁盘空间',
+    'metadata_cache_bytes': '各缓存占用的空间',
+    'metadata_tag_pool_pending': '等待写入标签的任务数',
+    'metadata_tag_saves_total': '保存标签的次数：in_place原地更新，rewrite重写整个文件'
+}
+
+def format_label(name):
+    """由文件名或URL得到用于指标的格式标签"""
+    ext = os.path.splitext(urlparse(name).path)[1].lower().lstrip('.')
+    return METRIC_FORMATS.get(ext, 'other')
+
+class Metrics:
+    """线程安全的计数器和直方图，按Prometheus文本格式输出"""
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counters = {}  # (名称, 标签) -> 值
+        self.histograms = {}  # (名称, 标签) -> [各区间计数..., 总和, 次数]
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            data = self.histograms.get(key)
+            if data is None:
+                data = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+    
+    def observe_stage(self, stage, seconds, file_format):
+        self.observe('metadata_stage_duration_seconds', seconds, stage=stage, format=file_format)
+    
+    @contextmanager
+    def stage_timer(self, stage, file_format):
+        """记录代码块的耗时，出错时同样记录"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start, file_format)
+    
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}'
+    
+    def render(self, gauges):
+        """生成Prometheus文本格式，gauges为 [(名称, 标签字典, 值)]"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(data)) for key, data in self.histograms.items())
+        
+        lines = []
+        declared = set()
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                if name in METRIC_HELP:
+                    lines.append(f'# HELP {name} {METRIC_HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+        
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for name, labels, value in gauges:
+            declare(name, 'gauge')
+            lines.append(f'{name}{self._labels(sorted(labels.items()))} {value}')
+        for (name, labels), data in histograms:
+            declare(name, 'histogram')
+            for bound, count in zip(self.buckets, data):
+                lines.append(f'{name}_bucket{self._labels(labels, ("le", bound))} {count}')
+            lines.append(f'{name}_bucket{self._labels(labels, ("le", "+Inf"))} {data[-1]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {data[-2]}')
+            lines.append(f'{name}_count{self._labels(labels)} {data[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# 性能分析（默认关闭）
+PROFILE_THRESHOLD = 0  # 耗时超过此值（秒）的请求保存调用栈采样，0表示关闭
+PROFILE_SAMPLE_RATE = 0  # 每N个请求用cProfile完整分析一次，0表示关闭
+PROFILE_KEEP = 20  # 保留最近的分析结果数
+PROFILE_INTERVAL = 0.005  # 调用栈采样间隔（秒）
+profiler = None
+
+class RequestProfiler:
+    """请求性能分析：后台线程对进行中的请求采样调用栈，只保存慢请求的结果；
+    每N个请求用cProfile完整分析一次。请求线程中只登记和注销，不做额外工作"""
+    def __init__(self, profile_dir, threshold, sample_rate, keep, interval):
+        self.profile_dir = profile_dir
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}  # 线程ID -> 正在采样的请求
+        self.requests = itertools.count(1)
+        self.cprofile_busy = False  # 同一时间只能有一个cProfile
+        self.stopped = threading.Event()
+        os.makedirs(profile_dir, exist_ok=True)
+        if threshold > 0:
+            threading.Thread(target=self._sample_loop, daemon=True, name='request-profiler').start()
+    
+    def stop(self):
+        self.stopped.set()
+    
+    def begin(self):
+        """请求开始时调用，返回分析会话"""
+        session = {'start': time.perf_counter(), 'thread': threading.get_ident(), 'stacks': Counter(), 'profile': None}
+        with self.lock:
+            if self.sample_rate and next(self.requests) % self.sample_rate == 0 and not self.cprofile_busy:
+                self.cprofile_busy = True
+                session['profile'] = cProfile.Profile()
+            elif self.threshold > 0:
+                self.active[session['thread']] = session
+        if session['profile']:
+            session['profile'].enable()
+        return session
+    
+    def end(self, session, name):
+        """请求结束时调用，需要时保存分析结果"""
+        duration = time.perf_counter() - session['start']
+        profile = session['profile']
+        if profile:
+            profile.disable()
+            with self.lock:
+                self.cprofile_busy = False
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(60)
+            self._save(name, duration, 'cprofile', output.getvalue(), profile)
+            return
+        
+        with self.lock:
+            self.active.pop(session['thread'], None)
+        if duration >= self.threshold and session['stacks']:
+            self._save(name, duration, 'sampling', self._format_stacks(session['stacks']))
+    
+    def _sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                sessions = list(self.active.items())
+            if not sessions:
+                continue
+            frames = sys._current_frames()
+            samples = []
+            for thread_id, session in sessions:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    samples.append((thread_id, session, ';'.join(reversed(stack))))
+            # 只记录仍在进行的请求：end()注销后会读取stacks，之后不能再写入
+            with self.lock:
+                for thread_id, session, stack in samples:
+                    if self.active.get(thread_id) is session:
+                        session['stacks'][stack] += 1
+    
+    def _format_stacks(self, stacks):
+        """按函数汇总采样数，并附上可用于生成火焰图的折叠调用栈"""
+        total = sum(stacks.values())
+        inclusive = Counter()
+        for stack, count in stacks.items():
+            # 同一函数的不同行合并计算
+            for function in set(frame.rsplit(':', 1)[0] + ')' for frame in stack.split(';')):
+                inclusive[function] += count
+        lines = [f"采样数: {total}, 采样间隔: {self.interval * 1000:g}ms", '', '包含子调用的采样占比:']
+        for function, count in inclusive.most_common(40):
+            lines.append(f"{count * 100 / total:6.1f}%  {count:6d}  {function}")
+        lines += ['', '折叠调用栈:']
+        lines += [f"{stack} {count}" for stack, count in stacks.most_common()]
+        return '\n'.join(lines) + '\n'
+    
+    def _save(self, name, duration, kind, report, profile=None):
+        profile_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+        try:
+            with open(os.path.join(self.profile_dir, f"{profile_id}.json"), 'w', encoding='utf-8') as f:
+                json.dump({
+                    'id': profile_id,
+                    'request': name,
+                    'duration': round(duration, 4),
+                    'kind': kind,
+                    'created_time': time.time(),
+                    'report': report
+                }, f, ensure_ascii=False)
+            if profile:
+                profile.dump_stats(os.path.join(self.profile_dir, f"{profile_id}.prof"))
+            logger.info(f"已保存性能分析: {name}, 耗时 {duration:.3f}秒")
+        except OSError as e:
+            logger.warning(f"保存性能分析失败: {e}")
+        self._trim()
+    
+    def _trim(self):
+        """只保留最近的分析结果"""
+        with self.lock:
+            saved = sorted(name[:-5] for name in os.listdir(self.profile_dir) if name.endswith('.json'))
+            for profile_id in saved[:-self.keep]:
+                for ext in ('.json', '.prof'):
+                    path = os.path.join(self.profile_dir, profile_id + ext)
+                    if os.path.exists(path):
+                        os.remove(path)
+    
+    def entries(self):
+        """返回保存的分析结果（不含内容），最新的在前"""
+        results = []
+        for name in sorted(os.listdir(self.profile_dir), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.profile_dir, name), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            entry.pop('report', None)
+            entry['has_pstats'] = os.path.exists(os.path.join(self.profile_dir, f"{entry['id']}.prof"))
+            results.append(entry)
+        return results
+    
+    def path(self, profile_id, ext='.json'):
+        """返回分析结果文件路径，不存在时返回None"""
+        if not all(c.isalnum() or c == '_' for c in profile_id):
+            return None
+        path = os.path.join(self.profile_dir, profile_id + ext)
+        return path if os.path.exists(path) else None
+
+# 写入标签时按子阶段记录耗时（可能在进程池中执行，结果随返回值带回）
+_stage_clock = threading.local()
+_tag_save = threading.local()
+
+def mark_stage(stage):
+    """记录当前线程中某个子阶段的结束时间"""
+    marks = getattr(_stage_clock, 'marks', None)
+    if marks is not None:
+        marks[stage] = time.perf_counter()
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """记录连接复用情况的连接池适配器"""
+    def __init__(self, *args, **kwargs):
+        self.retired_requests = 0
+        self.retired_connections = 0
+        super().__init__(*args, **kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # 连接池被淘汰时保留其计数
+        pools = self.poolmanager.pools
+        dispose = pools.dispose_func
+        def dispose_and_count(pool):
+            self.retired_requests += pool.num_requests
+            self.retired_connections += pool.num_connections
+            if dispose:
+                dispose(pool)
+        pools.dispose_func = dispose_and_count
+    
+    def stats(self):
+        """返回请求数、新建连接数和当前连接池数量"""
+        requests_count = self.retired_requests
+        connections_count = self.retired_connections
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections_count += pool.num_connections
+        return requests_count, connections_count, len(pools)
+
+def _create_http_session():
+    """根据配置创建共享会话"""
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': HTTP_USER_AGENT,
+        'Connection': 'keep-alive'
+    })
+    
+    adapter = PooledHTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    # 为常用CDN主机单独设置连接数
+    for host, size in HTTP_HOST_POOL_SIZES.items():
+        host_adapter = PooledHTTPAdapter(pool_connections=1, pool_maxsize=int(size))
+        session.mount(f'http://{host}/', host_adapter)
+        session.mount(f'https://{host}/', host_adapter)
+    return session
+
+def get_http_session():
+    """获取进程内共享的HTTP会话"""
+    global http_session
+    if http_session is None:
+        with http_session_lock:
+            if http_session is None:
+                http_session = _create_http_session()
+    return http_session
+
+def http_timeout(read_timeout=None):
+    """返回(连接超时, 读取超时)"""
+    return (HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT)
+
+def get_http_pool_stats():
+    """统计连接池命中（复用连接）与未命中（新建连接）次数"""
+    session = http_session
+    if session is None:
+        return {'requests': 0, 'hits': 0, 'misses': 0, 'pools': 0}
+    
+    requests_count = connections_count = pools_count = 0
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen or not isinstance(adapter, PooledHTTPAdapter):
+            continue
+        seen.add(id(adapter))
+        r, c, p = adapter.stats()
+        requests_count += r
+        connections_count += c
+        pools_count += p
+    return {
+        'requests': requests_count,
+        'hits': max(0, requests_count - connections_count),
+        'misses': connections_count,
+        'pools': pools_count
+    }
+
+def _save_response(response, file_path, progress=None, hasher=None):
+    """将响应内容写入文件，返回写入的字节数"""
+    total = int(response.headers.get('Content-Length') or 0)
+    downloaded = 0
+    with open(file_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=8192):
+            if chunk:
+                f.write(chunk)
+                downloaded += len(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                if progress:
+                    progress(downloaded, total)
+    metrics.inc('metadata_bytes_in_total', downloaded, kind='audio')
+    return downloaded
+
+def download_file(url, file_path, progress=None):
+    """下载文件到指定路径，progress(已下载字节数, 总字节数)用于报告进度"""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'identity',
-            'Connection': 'keep-alive'
-        }
+        if try_segmented_download(url, file_path, progress) is not None:
+            return True
         
         logger.info(f"开始下载: {url}")
-        response = requests.get(url, stream=True, headers=headers, timeout=60)
-        response.raise_for_status()
-        
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        start = time.perf_counter()
+        with get_http_session().get(url, stream=True, headers=DOWNLOAD_HEADERS, timeout=http_timeout()) as response:
+            metrics.observe_stage('connect', time.perf_counter() - start, format_label(url))
+            response.raise_for_status()
+            _save_response(response, file_path, progress)
         
         logger.info(f"下载完成: {file_path}, 文件大小: {os.path.getsize(file_path)} bytes")
         return True
@@ -57,23 +540,638 @@ def download_file(url, file_path):
         logger.error(f"下载失败: {e}")
         return False
 
-def download_cover(cover_url):
-    """下载封面图片"""
+class SegmentedDownloadUnsupported(Exception):
+    """上游不能按范围返回内容（或内容已变化），需要改用单连接下载"""
+
+def probe_ranges(url):
+    """HEAD请求确认上游支持Range且文件足够大，返回响应；不适合分段下载时返回None"""
+    start = time.perf_counter()
     try:
+        response = get_http_session().head(
+            url, headers={**DOWNLOAD_HEADERS, 'Accept-Encoding': 'identity'},
+            allow_redirects=True, timeout=http_timeout()
+        )
+    except requests.RequestException as e:
+        # HEAD失败不影响下载，改用单连接
+        logger.warning(f"探测分段下载失败: {e}")
+        return None
+    response.close()
+    size = int(response.headers.get('Content-Length') or 0)
+    if (response.status_code != 200 or response.headers.get('Accept-Ranges', '').lower() != 'bytes'
+            or response.headers.get('Content-Encoding') or size < DOWNLOAD_SEGMENT_MIN_BYTES):
+        return None
+    metrics.observe_stage('connect', time.perf_counter() - start, format_label(url))
+    return response
+
+def _download_segment(url, file_path, segment, validator, advance, stop):
+    """下载一个字节范围，连接中断时从已写入的位置继续；连续多次没有进展时放弃"""
+    failures = 0
+    while segment['position'] <= segment['end'] and not stop.is_set():
+        attempt_start = segment['position']
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            **DOWNLOAD_HEADERS,
+            'Range': f"bytes={segment['position']}-{segment['end']}",
+            'Accept-Encoding': 'identity'
         }
+        if validator:
+            # 文件在下载期间变化时服务器返回完整的新内容，而不是拼接新旧两个版本
+            headers['If-Range'] = validator
+        try:
+            with get_http_session().get(url, stream=True, headers=headers, timeout=http_timeout()) as response:
+                content_range = response.headers.get('Content-Range', '')
+                if response.status_code != 206 or not content_range.startswith(f"bytes {segment['position']}-"):
+                    raise SegmentedDownloadUnsupported(f"分段请求返回 {response.status_code} {content_range}")
+                with open(file_path, 'r+b') as f:
+                    f.seek(segment['position'])
+                    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                        if stop.is_set():
+                            return
+                        chunk = chunk[:segment['end'] + 1 - segment['position']]
+                        if chunk:
+                            f.write(chunk)
+                            segment['position'] += len(chunk)
+                            advance(len(chunk))
+                        if segment['position'] > segment['end']:
+                            break
+            if segment['position'] <= segment['end']:
+                raise IOError('连接提前结束')
+        except SegmentedDownloadUnsupported:
+            raise
+        except Exception as e:
+            failures = failures + 1 if segment['position'] == attempt_start else 1
+            if failures > DOWNLOAD_RETRIES:
+                raise
+            metrics.inc('metadata_download_retries_total')
+            logger.warning(f"分段 {segment['start']}-{segment['end']} 下载中断，从 {segment['position']} 继续（第{failures}次重试）: {e}")
+            stop.wait(min(5, 0.5 * 2 ** (failures - 1)))
+
+def download_segmented(url, file_path, progress=None):
+    """分段并行下载到预分配的文件，成功时返回HEAD响应；上游不支持Range或文件较小时返回None"""
+    head = probe_ranges(url)
+    if head is None:
+        return None
+    
+    total = int(head.headers['Content-Length'])
+    # If-Range只接受强ETag或Last-Modified
+    validator = head.headers.get('ETag')
+    if not validator or validator.startswith('W/'):
+        validator = head.headers.get('Last-Modified')
+    
+    with open(file_path, 'wb') as f:
+        f.truncate(total)
+    segment_size = -(-total // DOWNLOAD_SEGMENTS)
+    segments = [
+        {'start': offset, 'position': offset, 'end': min(offset + segment_size, total) - 1}
+        for offset in range(0, total, segment_size)
+    ]
+    logger.info(f"分段下载: {url}, {len(segments)}段, 文件大小: {total} bytes")
+    
+    lock = threading.Lock()
+    downloaded = 0
+    def advance(size):
+        nonlocal downloaded
+        with lock:
+            downloaded += size
+            if progress:
+                progress(downloaded, total)
+    
+    # 任一分段失败时通知其他分段停止
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix='segment-download') as executor:
+        futures = [executor.submit(_download_segment, url, file_path, segment, validator, advance, stop) for segment in segments]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            stop.set()
+            raise
+    
+    metrics.inc('metadata_bytes_in_total', total, kind='audio')
+    logger.info(f"下载完成: {file_path}, 文件大小: {total} bytes")
+    return head
+
+def try_segmented_download(url, file_path, progress=None):
+    """启用时尝试分段下载，返回HEAD响应；返回None表示应改用单连接下载"""
+    if DOWNLOAD_SEGMENTS <= 1:
+        return None
+    try:
+        return download_segmented(url, file_path, progress)
+    except SegmentedDownloadUnsupported as e:
+        logger.warning(f"上游不支持分段下载，改用单连接: {e}")
+        return None
+
+class SourceCache:
+    """按内容哈希保存已下载的源音频，使用ETag/Last-Modified重新验证"""
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.urls = {}  # url -> {'hash', 'etag', 'last_modified'}
+        self.blobs = OrderedDict()  # hash -> 文件大小，按最近使用排序
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+    
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, digest)
+    
+    def _load_index(self):
+        """读取索引，丢弃已不存在的缓存文件"""
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except Exception as e:
+            logger.warning(f"读取源文件缓存索引失败: {e}")
+            return
+        
+        for digest in index.get('blobs', []):
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                size = os.path.getsize(path)
+                self.blobs[digest] = size
+                self.total_bytes += size
+        self.urls = {url: entry for url, entry in index.get('urls', {}).items() if entry.get('hash') in self.blobs}
+        self._evict()
+    
+    def _save_index(self):
+        """保存索引（调用时需持有锁）"""
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'urls': self.urls, 'blobs': list(self.blobs)}, f)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.warning(f"保存源文件缓存索引失败: {e}")
+    
+    def _evict(self):
+        """按最近最少使用淘汰缓存文件，直到不超过容量（调用时需持有锁）"""
+        while self.total_bytes > self.max_bytes and self.blobs:
+            digest, size = self.blobs.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            self.urls = {url: entry for url, entry in self.urls.items() if entry['hash'] != digest}
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError as e:
+                logger.warning(f"删除缓存文件失败: {e}")
+    
+    def _store(self, url, response, file_path, digest, size):
+        """把刚下载的文件加入缓存"""
+        with self.lock:
+            known = digest in self.blobs
+        
+        # 内容相同的文件只保存一份。
+        # 这里必须复制而不能用硬链接或移动：随后写入标签会原地修改file_path（mutagen直接改写文件），
+        # 与缓存共用同一份数据时会把标签写进缓存的源文件。代价是未命中时源文件写入两次，
+        # 命中时只从缓存复制一次且不再下载
+        if not known and size <= self.max_bytes:
+            tmp_path = self.blob_path(digest) + f'.{uuid.uuid4().hex}.tmp'
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, self.blob_path(digest))
+        
+        with self.lock:
+            if digest not in self.blobs:
+                if size > self.max_bytes:
+                    return
+                self.blobs[digest] = size
+                self.total_bytes += size
+            self.blobs.move_to_end(digest)
+            self.urls[url] = {
+                'hash': digest,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+            self._evict()
+            self._save_index()
+    
+    def revalidation_headers(self, url, headers):
+        """为已缓存的URL添加条件请求头，返回缓存条目；未缓存时返回None"""
+        with self.lock:
+            entry = self.urls.get(url)
+            if not entry or not (entry.get('etag') or entry.get('last_modified')):
+                return None
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            return entry
+    
+    def current_hash(self, url):
+        """用条件请求确认上游内容未变化，返回其内容哈希；没有验证信息或内容已变化时返回None"""
+        headers = dict(DOWNLOAD_HEADERS)
+        entry = self.revalidation_headers(url, headers)
+        if entry is None:
+            return None
+        try:
+            response = get_http_session().head(url, headers=headers, allow_redirects=True, timeout=http_timeout())
+            response.close()
+        except requests.RequestException as e:
+            logger.warning(f"重新验证源文件失败: {e}")
+            return None
+        # 不支持条件请求的上游返回200时，以ETag是否一致为准
+        if response.status_code == 304 or (
+                response.status_code == 200 and entry.get('etag') and response.headers.get('ETag') == entry['etag']):
+            return entry['hash']
+        return None
+    
+    def record(self, url, response, file_path, digest, size):
+        """记录一次完整下载并加入缓存"""
+        with self.lock:
+            self.misses += 1
+        self._store(url, response, file_path, digest, size)
+    
+    def fetch(self, url, file_path, progress=None):
+        """获取源文件到指定路径，缓存有效时不重新下载内容"""
+        headers = dict(DOWNLOAD_HEADERS)
+        entry = self.revalidation_headers(url, headers)
+        
+        try:
+            # 未缓存过的URL直接分段下载，已缓存的URL先做条件请求
+            if entry is None:
+                head = try_segmented_download(url, file_path, progress)
+                if head is not None:
+                    self.record(url, head, file_path, file_sha256(file_path), os.path.getsize(file_path))
+                    return True
+            
+            logger.info(f"开始下载: {url}")
+            start = time.perf_counter()
+            with get_http_session().get(url, stream=True, headers=headers, timeout=http_timeout()) as response:
+                metrics.observe_stage('connect', time.perf_counter() - start, format_label(url))
+                if response.status_code == 304 and entry:
+                    if self.restore(entry['hash'], file_path, progress):
+                        logger.info(f"源文件缓存命中: {url}")
+                        return True
+                    # 缓存文件已被淘汰，重新完整下载
+                    return download_file(url, file_path, progress)
+                
+                response.raise_for_status()
+                hasher = hashlib.sha256()
+                size = _save_response(response, file_path, progress, hasher)
+                logger.info(f"下载完成: {file_path}, 文件大小: {size} bytes")
+            
+            self.record(url, response, file_path, hasher.hexdigest(), size)
+            return True
+        
+        except Exception as e:
+            logger.error(f"下载失败: {e}")
+            return False
+    
+    def restore(self, digest, file_path, progress=None):
+        """从缓存复制文件"""
+        with self.lock:
+            size = self.blobs.get(digest)
+            if size is None:
+                return False
+            self.blobs.move_to_end(digest)
+        try:
+            shutil.copyfile(self.blob_path(digest), file_path)
+        except OSError:
+            return False
+        
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += size
+        if progress:
+            progress(size, size)
+        return True
+    
+    def report(self):
+        """返回缓存使用情况与命中统计"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'urls': len(self.urls),
+                'files': len(self.blobs),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'evictions': self.evictions
+            }
+
+def fetch_source(url, file_path, progress=None):
+    """下载源音频，启用缓存时优先使用缓存"""
+    if source_cache is not None:
+        return source_cache.fetch(url, file_path, progress)
+    return download_file(url, file_path, progress)
+
+def download_cover(cover_url, timeout=None):
+    """下载封面图片"""
+    try:
         logger.info(f"开始下载封面: {cover_url}")
-        response = requests.get(cover_url, headers=headers, timeout=30)
-        response.raise_for_status()
+        with metrics.stage_timer('cover', 'image'):
+            response = get_http_session().get(cover_url, timeout=http_timeout(timeout or COVER_TIMEOUT))
+            response.raise_for_status()
         logger.info("封面下载成功")
+        metrics.inc('metadata_bytes_in_total', len(response.content), kind='cover')
         return response.content
     except Exception as e:
         logger.error(f"封面下载失败: {e}")
         return None
 
+class CoverCache:
+    """封面图片缓存：按URL索引，按内容哈希去重，内存LRU加可选磁盘层"""
+    def __init__(self, max_memory_bytes, disk_dir=None, max_disk_bytes=0, ttl=3600):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir if max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.urls = OrderedDict()  # url -> (hash, 缓存时间)
+        self.memory = OrderedDict()  # hash -> bytes
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # hash -> 文件大小
+        self.disk_bytes = 0
+        self.inflight = {}  # url -> 正在进行的下载，同一封面只下载一次
+        self.variants = OrderedDict()  # (原图hash, 尺寸, 质量) -> 处理后的hash
+        self.variant_hits = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.deduplicated = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            for digest in os.listdir(self.disk_dir):
+                path = os.path.join(self.disk_dir, digest)
+                if len(digest) == 64 and os.path.isfile(path):
+                    self.disk[digest] = os.path.getsize(path)
+                    self.disk_bytes += self.disk[digest]
+            self._evict_disk()
+    
+    def _lookup(self, url):
+        """查找缓存中的封面（调用时需持有锁）"""
+        entry = self.urls.get(url)
+        if entry is None:
+            return None
+        digest, cached_time = entry
+        if time.time() - cached_time > self.ttl:
+            del self.urls[url]
+            return None
+        
+        self.urls.move_to_end(url)
+        return self._load(digest)
+    
+    def _load(self, digest):
+        """按内容哈希从内存层或磁盘层读取（调用时需持有锁）"""
+        if digest in self.memory:
+            self.memory.move_to_end(digest)
+            return self.memory[digest]
+        if digest in self.disk:
+            try:
+                with open(os.path.join(self.disk_dir, digest), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+            self.disk.move_to_end(digest)
+            self._remember(digest, data)
+            return data
+        return None
+    
+    def _remember(self, digest, data):
+        """放入内存层，超出容量时把最久未用的封面移到磁盘层（调用时需持有锁）"""
+        if digest in self.memory:
+            self.memory.move_to_end(digest)
+            return
+        self.memory[digest] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            old_digest, old_data = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_data)
+            self._spill(old_digest, old_data)
+    
+    def _spill(self, digest, data):
+        """写入磁盘层（调用时需持有锁）"""
+        if not self.disk_dir or digest in self.disk or len(data) > self.max_disk_bytes:
+            return
+        try:
+            with open(os.path.join(self.disk_dir, digest), 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            logger.warning(f"写入封面缓存失败: {e}")
+            return
+        self.disk[digest] = len(data)
+        self.disk_bytes += len(data)
+        self._evict_disk()
+    
+    def _evict_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            digest, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.disk_dir, digest))
+            except OSError:
+                pass
+    
+    def put(self, url, data):
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if digest in self.memory or digest in self.disk:
+                self.deduplicated += 1
+            self.urls[url] = (digest, time.time())
+            self.urls.move_to_end(url)
+            while len(self.urls) > COVER_CACHE_MAX_URLS:
+                self.urls.popitem(last=False)
+            self._remember(digest, data)
+    
+    def lookup(self, url):
+        """只查找缓存，不下载"""
+        with self.lock:
+            data = self._lookup(url)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += len(data)
+            return data
+    
+    def get_or_fetch(self, url, fetch):
+        """返回缓存的封面，未命中时调用fetch(url)下载；并发请求同一URL时只下载一次"""
+        with self.lock:
+            data = self._lookup(url)
+            if data is not None:
+                self.hits += 1
+                self.bytes_saved += len(data)
+                return data
+            pending = self.inflight.get(url)
+            if pending is None:
+                pending = self.inflight[url] = {'event': threading.Event(), 'data': None}
+                leader = True
+            else:
+                leader = False
+        
+        # 等待正在进行的同一封面下载，共用其结果
+        if not leader:
+            pending['event'].wait(COVER_TIMEOUT)
+            data = pending['data']
+            if data is not None:
+                with self.lock:
+                    self.hits += 1
+                    self.bytes_saved += len(data)
+            return data
+        
+        try:
+            with self.lock:
+                self.misses += 1
+            data = fetch(url)
+            if data:
+                self.put(url, data)
+            pending['data'] = data
+            return data
+        finally:
+            with self.lock:
+                self.inflight.pop(url, None)
+            pending['event'].set()
+    
+    def get_variant(self, data, max_size, quality, build):
+        """返回封面处理后的版本，按 (原图哈希, 尺寸, 质量) 缓存；并发请求同一组合时只处理一次"""
+        key = (hashlib.sha256(data).hexdigest(), max_size, quality)
+        with self.lock:
+            digest = self.variants.get(key)
+            variant = self._load(digest) if digest else None
+            if variant is not None:
+                self.variants.move_to_end(key)
+                self.variant_hits += 1
+                return variant
+            pending = self.inflight.get(key)
+            if pending is None:
+                pending = self.inflight[key] = {'event': threading.Event(), 'data': None}
+                leader = True
+            else:
+                leader = False
+        
+        if not leader:
+            pending['event'].wait(COVER_TIMEOUT)
+            return pending['data'] or data
+        
+        try:
+            variant = build(data, max_size, quality)
+            digest = hashlib.sha256(variant).hexdigest()
+            with self.lock:
+                self.variants[key] = digest
+                self.variants.move_to_end(key)
+                while len(self.variants) > COVER_CACHE_MAX_URLS:
+                    self.variants.popitem(last=False)
+                self._remember(digest, variant)
+            pending['data'] = variant
+            return variant
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            pending['event'].set()
+    
+    def report(self):
+        """返回缓存使用情况、命中率和节省的下载字节数"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'urls': len(self.urls),
+                'variants': len(self.variants),
+                'variant_hits': self.variant_hits,
+                'memory_bytes': self.memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'disk_bytes': self.disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'deduplicated': self.deduplicated
+            }
+
+def get_cover(cover_url):
+    """获取封面，启用缓存时同一封面只下载一次"""
+    if cover_cache is not None:
+        return normalize_cover(cover_cache.get_or_fetch(cover_url, download_cover))
+    return normalize_cover(download_cover(cover_url))
+
+def cover_mime(data):
+    """根据文件头判断封面的图片格式"""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:2] == b'BM':
+        return 'image/bmp'
+    return 'image/jpeg'
+
+def resize_cover(data, max_size, quality):
+    """缩小到最长边不超过max_size并编码为JPEG，不需要处理或处理失败时返回原图"""
+    try:
+        with metrics.stage_timer('resize', 'image'):
+            image = Image.open(io.BytesIO(data))
+            if max(image.size) <= max_size and image.format == 'JPEG':
+                return data
+            resized = max(image.size) > max_size
+            # JPEG解码时直接按比例缩小，避免解码完整的大图
+            image.draft('RGB', (max_size, max_size))
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # 透明部分填充为白色
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+        
+        # 尺寸未变且重新编码后反而更大时保留原图
+        if not resized and buffer.tell() >= len(data):
+            return data
+        logger.info(f"封面已处理: {len(data)} -> {buffer.tell()} bytes")
+        return buffer.getvalue()
+    except Exception as e:
+        logger.warning(f"封面处理失败，使用原图: {e}")
+        return data
+
+def normalize_cover(data):
+    """按配置缩小并重新编码封面，未安装Pillow或未启用时返回原图"""
+    if not data or COVER_MAX_SIZE <= 0 or Image is None:
+        return data
+    if cover_cache is not None:
+        return cover_cache.get_variant(data, COVER_MAX_SIZE, COVER_QUALITY, resize_cover)
+    return resize_cover(data, COVER_MAX_SIZE, COVER_QUALITY)
+
+def cover_variant():
+    """当前的封面处理参数，参与结果缓存的键"""
+    if COVER_MAX_SIZE <= 0 or Image is None:
+        return ''
+    return f"{COVER_MAX_SIZE}/{COVER_QUALITY}"
+
+def start_cover_download(cover_url):
+    """在后台线程中开始下载封面，返回Future"""
+    global cover_executor
+    with cover_executor_lock:
+        if cover_executor is None:
+            cover_executor = ThreadPoolExecutor(max_workers=COVER_WORKERS, thread_name_prefix='cover-download')
+    return cover_executor.submit(get_cover, cover_url)
+
+def wait_cover_download(future):
+    """等待封面下载结束，超时或失败时返回None"""
+    try:
+        return future.result(timeout=COVER_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        logger.error(f"封面下载超时 ({COVER_TIMEOUT}秒)，将不添加封面")
+    except Exception as e:
+        logger.error(f"封面下载失败: {e}")
+    return None
+
 def strip_existing_metadata(file_path):
-    """删除文件中的所有现有元数据"""
+    """删除文件中的所有现有元数据，每种格式只写入一次文件"""
     try:
         logger.info(f"开始清理现有元数据: {file_path}")
         
@@ -87,31 +1185,23 @@ def strip_existing_metadata(file_path):
                 logger.info("MP3 ID3标签删除成功")
             except Exception as e:
                 logger.warning(f"删除MP3标签时出错: {e}")
-                # 尝试直接操作文件
-                try:
-                    audio = MP3(file_path)
-                    if audio.tags:
-                        audio.delete()
-                        audio.save()
-                except:
-                    pass
             
         elif file_ext == '.flac':
             # 对于FLAC，清除所有标签
             try:
                 audio = FLAC(file_path)
                 audio.clear()
-                audio.save()
+                audio.clear_pictures()
+                audio.save(deleteid3=True)
                 logger.info("FLAC标签清除成功")
             except Exception as e:
                 logger.warning(f"清除FLAC标签时出错: {e}")
             
         elif file_ext in ['.ogg', '.oga']:
-            # 对于OGG，清除所有标签
+            # 对于OGG，清除所有标签（delete会直接写回文件）
             try:
                 audio = OggVorbis(file_path)
                 audio.delete()
-                audio.save()
                 logger.info("OGG标签清除成功")
             except Exception as e:
                 logger.warning(f"清除OGG标签时出错: {e}")
@@ -120,8 +1210,8 @@ def strip_existing_metadata(file_path):
             # 对于MP4，清除所有标签
             try:
                 audio = MP4(file_path)
-                audio.delete()
-                audio.save()
+                if audio.tags is not None:
+                    audio.delete()
                 logger.info("MP4标签清除成功")
             except Exception as e:
                 logger.warning(f"清除MP4标签时出错: {e}")
@@ -130,9 +1220,8 @@ def strip_existing_metadata(file_path):
             # 对于WAV，尝试清除ID3标签
             try:
                 audio = WAVE(file_path)
-                if hasattr(audio, 'tags') and audio.tags:
+                if audio.tags:
                     audio.delete()
-                    audio.save()
                 logger.info("WAV标签清除成功")
             except Exception as e:
                 logger.warning(f"清除WAV标签时出错: {e}")
@@ -141,9 +1230,8 @@ def strip_existing_metadata(file_path):
             # 对于AIFF，尝试清除ID3标签
             try:
                 audio = AIFF(file_path)
-                if hasattr(audio, 'tags') and audio.tags:
+                if audio.tags:
                     audio.delete()
-                    audio.save()
                 logger.info("AIFF标签清除成功")
             except Exception as e:
                 logger.warning(f"清除AIFF标签时出错: {e}")
@@ -156,65 +1244,65 @@ def strip_existing_metadata(file_path):
         logger.error(traceback.format_exc())
         return False
 
+def tag_padding(info):
+    """保存标签时的填充策略：原有空间放得下新标签时原地更新，否则重写文件并预留填充"""
+    reserve = TAG_PADDING + info.size // 100
+    # info.padding是保存后剩余的空间；FLAC文件开头的ID3v2标签在保存时被删除，它占用的空间也计入其中，
+    # 原样保留这些空间时音频数据位置不变，仍是原地更新
+    # 旧标签远大于新标签时（如去掉了大封面）不保留过多的空白
+    if 0 <= info.padding <= reserve * 2:
+        _tag_save.mode = 'in_place'
+        return info.padding
+    _tag_save.mode = 'rewrite'
+    return reserve
+
+def add_id3_frames(tags, metadata, with_cover=True):
+    """在内存中向ID3标签写入元数据帧"""
+    # 设置基本元数据
+    if metadata.get('title'):
+        tags.add(TIT2(encoding=3, text=metadata['title']))
+    if metadata.get('artist'):
+        tags.add(TPE1(encoding=3, text=metadata['artist']))
+    if metadata.get('album'):
+        tags.add(TALB(encoding=3, text=metadata['album']))
+    if metadata.get('year'):
+        # 确保年份是ASCII字符串
+        year_str = str(metadata['year'])
+        if year_str:
+            tags.add(TDRC(encoding=3, text=year_str))
+    
+    # 添加歌词
+    if metadata.get('lyrics'):
+        tags.add(USLT(encoding=3, lang='eng', desc='', text=metadata['lyrics']))
+    
+    # 添加注释
+    if metadata.get('tips'):
+        tags.add(COMM(encoding=3, lang='eng', desc='', text=metadata['tips']))
+    
+    # 添加封面
+    if with_cover and metadata.get('cover_data'):
+        tags.add(APIC(
+            encoding=3,
+            mime=cover_mime(metadata['cover_data']),
+            type=3,
+            desc='Cover',
+            data=metadata['cover_data']
+        ))
+
 def add_metadata_to_mp3(file_path, metadata):
-    """向MP3文件添加元数据"""
+    """向MP3文件添加元数据，新标签在内存中生成后一次性替换旧的ID3v2/ID3v1标签"""
     try:
         logger.info(f"开始处理MP3文件: {file_path}")
         
-        # 确保彻底删除现有标签
-        try:
-            delete(file_path)
-        except:
-            pass
-        
-        # 重新加载文件
-        audio = MP3(file_path)
-        
-        # 检查是否还有标签，如果有则删除
-        if audio.tags:
-            audio.delete()
-            audio.save()
-        
-        # 重新加载确保没有标签
-        audio = MP3(file_path)
-        
-        # 添加新标签
-        audio.add_tags()
-        tags = audio.tags
-        
-        # 设置基本元数据
-        if metadata.get('title'):
-            tags.add(TIT2(encoding=3, text=metadata['title']))
-        if metadata.get('artist'):
-            tags.add(TPE1(encoding=3, text=metadata['artist']))
-        if metadata.get('album'):
-            tags.add(TALB(encoding=3, text=metadata['album']))
-        if metadata.get('year'):
-            # 确保年份是ASCII字符串
-            year_str = str(metadata['year'])
-            if year_str:
-                tags.add(TDRC(encoding=3, text=year_str))
-        
-        # 添加歌词
-        if metadata.get('lyrics'):
-            tags.add(USLT(encoding=3, lang='eng', desc='', text=metadata['lyrics']))
+        # 确认是有效的MP3文件，旧标签在保存时整体替换
+        MP3(file_path)
+        mark_stage('strip')
         
-        # 添加注释
-        if metadata.get('tips'):
-            tags.add(COMM(encoding=3, lang='eng', desc='', text=metadata['tips']))
+        tags = ID3()
+        add_id3_frames(tags, metadata)
         
-        # 添加封面
-        if metadata.get('cover_data'):
-            cover_data = metadata['cover_data']
-            tags.add(APIC(
-                encoding=3,
-                mime='image/jpeg',
-                type=3,
-                desc='Cover',
-                data=cover_data
-            ))
-        
-        audio.save(v2_version=3)  # 使用ID3v2.3版本
+        # 使用ID3v2.3版本，同时删除ID3v1标签
+        tags.save(file_path, v1=ID3v1SaveOptions.REMOVE, v2_version=3, padding=tag_padding)
         logger.info("MP3元数据添加成功")
         return True
         
@@ -223,45 +1311,53 @@ def add_metadata_to_mp3(file_path, metadata):
         logger.error(traceback.format_exc())
         return False
 
+def add_vorbis_comments(tags, metadata):
+    """在内存中向Vorbis注释写入元数据"""
+    # 设置基本元数据
+    if metadata.get('title'):
+        tags['title'] = [metadata['title']]
+    if metadata.get('artist'):
+        tags['artist'] = [metadata['artist']]
+    if metadata.get('album'):
+        tags['album'] = [metadata['album']]
+    if metadata.get('year'):
+        tags['date'] = [str(metadata['year'])]
+    
+    # 添加歌词
+    if metadata.get('lyrics'):
+        tags['lyrics'] = [metadata['lyrics']]
+    
+    # 添加注释
+    if metadata.get('tips'):
+        tags['comment'] = [metadata['tips']]
+
+def build_flac_picture(cover_data):
+    """生成FLAC封面图片块"""
+    picture = Picture()
+    picture.type = 3
+    picture.mime = cover_mime(cover_data)
+    picture.desc = 'Cover'
+    picture.data = cover_data
+    return picture
+
 def add_metadata_to_flac(file_path, metadata):
     """向FLAC文件添加元数据"""
     try:
         logger.info(f"开始处理FLAC文件: {file_path}")
         audio = FLAC(file_path)
         
-        # 清除现有标签
+        # 清除现有标签和图片
         audio.clear()
+        audio.clear_pictures()
+        mark_stage('strip')
         
-        # 设置基本元数据
-        if metadata.get('title'):
-            audio['title'] = [metadata['title']]
-        if metadata.get('artist'):
-            audio['artist'] = [metadata['artist']]
-        if metadata.get('album'):
-            audio['album'] = [metadata['album']]
-        if metadata.get('year'):
-            audio['date'] = [str(metadata['year'])]
-        
-        # 添加歌词
-        if metadata.get('lyrics'):
-            audio['lyrics'] = [metadata['lyrics']]
-        
-        # 添加注释
-        if metadata.get('tips'):
-            audio['comment'] = [metadata['tips']]
+        add_vorbis_comments(audio, metadata)
         
         # 添加封面
         if metadata.get('cover_data'):
-            cover_data = metadata['cover_data']
-            picture = FLAC.Picture()
-            picture.type = 3
-            picture.mime = 'image/jpeg'
-            picture.desc = 'Cover'
-            picture.data = cover_data
-            audio.clear_pictures()
-            audio.add_picture(picture)
+            audio.add_picture(build_flac_picture(metadata['cover_data']))
         
-        audio.save()
+        audio.save(deleteid3=True, padding=tag_padding)
         logger.info("FLAC元数据添加成功")
         return True
         
@@ -276,8 +1372,9 @@ def add_metadata_to_ogg(file_path, metadata):
         logger.info(f"开始处理OGG文件: {file_path}")
         audio = OggVorbis(file_path)
         
-        # 清除现有标签
-        audio.delete()
+        # 在内存中清除现有标签
+        audio.tags.clear()
+        mark_stage('strip')
         
         # 设置基本元数据
         if metadata.get('title'):
@@ -293,7 +1390,7 @@ def add_metadata_to_ogg(file_path, metadata):
         if metadata.get('tips'):
             audio['comment'] = metadata['tips']
         
-        audio.save()
+        audio.save(padding=tag_padding)
         logger.info("OGG元数据添加成功")
         return True
         
@@ -307,8 +1404,12 @@ def add_metadata_to_mp4(file_path, metadata):
         logger.info(f"开始处理MP4文件: {file_path}")
         audio = MP4(file_path)
         
-        # 清除现有标签
-        audio.delete()
+        # 在内存中清除现有标签
+        if audio.tags is None:
+            audio.add_tags()
+        else:
+            audio.tags.clear()
+        mark_stage('strip')
         
         # MP4标签映射
         tag_map = {
@@ -334,12 +1435,14 @@ def add_metadata_to_mp4(file_path, metadata):
         if metadata.get('tips'):
             audio[tag_map['tips']] = [metadata['tips']]
         
-        # 添加封面
+        # 添加封面，MP4只支持JPEG和PNG两种格式标记
         if metadata.get('cover_data'):
             cover_data = metadata['cover_data']
-            audio['covr'] = [MP4.Cover(cover_data)]
+            image_format = MP4Cover.FORMAT_PNG if cover_mime(cover_data) == 'image/png' else MP4Cover.FORMAT_JPEG
+            audio['covr'] = [MP4Cover(cover_data, imageformat=image_format)]
         
-        audio.save()
+        # 填充保存在ilst之后的free原子中
+        audio.save(padding=tag_padding)
         logger.info("MP4元数据添加成功")
         return True
         
@@ -353,23 +1456,14 @@ def add_metadata_to_wav(file_path, metadata):
         logger.info(f"开始处理WAV文件: {file_path}")
         audio = WAVE(file_path)
         
-        # WAV文件通常使用ID3标签
-        if not audio.tags:
+        # WAV文件通常使用ID3标签，在内存中清除旧标签
+        if audio.tags is None:
             audio.add_tags()
+        else:
+            audio.tags.clear()
+        mark_stage('strip')
         
-        # 设置基本元数据
-        if metadata.get('title'):
-            audio.tags['TIT2'] = TIT2(encoding=3, text=metadata['title'])
-        if metadata.get('artist'):
-            audio.tags['TPE1'] = TPE1(encoding=3, text=metadata['artist'])
-        if metadata.get('album'):
-            audio.tags['TALB'] = TALB(encoding=3, text=metadata['album'])
-        if metadata.get('year'):
-            audio.tags['TDRC'] = TDRC(encoding=3, text=str(metadata['year']))
-        if metadata.get('lyrics'):
-            audio.tags['USLT'] = USLT(encoding=3, lang='eng', desc='', text=metadata['lyrics'])
-        if metadata.get('tips'):
-            audio.tags['COMM'] = COMM(encoding=3, lang='eng', desc='', text=metadata['tips'])
+        add_id3_frames(audio.tags, metadata, with_cover=False)
         
         audio.save()
         logger.info("WAV元数据添加成功")
@@ -385,23 +1479,14 @@ def add_metadata_to_aiff(file_path, metadata):
         logger.info(f"开始处理AIFF文件: {file_path}")
         audio = AIFF(file_path)
         
-        # AIFF文件通常使用ID3标签
-        if not audio.tags:
+        # AIFF文件通常使用ID3标签，在内存中清除旧标签
+        if audio.tags is None:
             audio.add_tags()
+        else:
+            audio.tags.clear()
+        mark_stage('strip')
         
-        # 设置基本元数据
-        if metadata.get('title'):
-            audio.tags['TIT2'] = TIT2(encoding=3, text=metadata['title'])
-        if metadata.get('artist'):
-            audio.tags['TPE1'] = TPE1(encoding=3, text=metadata['artist'])
-        if metadata.get('album'):
-            audio.tags['TALB'] = TALB(encoding=3, text=metadata['album'])
-        if metadata.get('year'):
-            audio.tags['TDRC'] = TDRC(encoding=3, text=str(metadata['year']))
-        if metadata.get('lyrics'):
-            audio.tags['USLT'] = USLT(encoding=3, lang='eng', desc='', text=metadata['lyrics'])
-        if metadata.get('tips'):
-            audio.tags['COMM'] = COMM(encoding=3, lang='eng', desc='', text=metadata['tips'])
+        add_id3_frames(audio.tags, metadata, with_cover=False)
         
         audio.save()
         logger.info("AIFF元数据添加成功")
@@ -412,11 +1497,8 @@ def add_metadata_to_aiff(file_path, metadata):
         return False
 
 def add_metadata_to_file(file_path, metadata):
-    """根据文件类型添加元数据"""
+    """根据文件类型添加元数据；旧标签在内存中清除，每个文件只写入一次"""
     try:
-        # 首先清理现有元数据
-        strip_existing_metadata(file_path)
-        
         # 检测文件类型
         file_ext = os.path.splitext(file_path)[1].lower()
         
@@ -441,104 +1523,1204 @@ def add_metadata_to_file(file_path, metadata):
         logger.error(traceback.format_exc())
         return False
 
-def cleanup_old_files():
-    """清理旧文件"""
+def _init_tag_worker(log_path, padding):
+    """进程池中的进程启动时设置日志和填充大小"""
+    global TAG_PADDING
+    TAG_PADDING = padding
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - [tag-worker] %(message)s',
+        handlers=[logging.StreamHandler(), logging.FileHandler(log_path)]
+    )
+
+def get_tag_pool():
+    """返回写入标签的进程池，未启用时返回None"""
+    global tag_pool
+    if TAG_PROCESSES <= 0:
+        return None
+    with tag_pool_lock:
+        if tag_pool is None:
+            # 使用spawn启动，避免在多线程服务器中fork
+            tag_pool = ProcessPoolExecutor(
+                max_workers=TAG_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_tag_worker,
+                initargs=(os.path.join(TEMP_DIR, 'music_metadata_processor.log'), TAG_PADDING)
+            )
+        return tag_pool
+
+def shutdown_tag_pool():
+    global tag_pool
+    with tag_pool_lock:
+        if tag_pool is not None:
+            tag_pool.shutdown(wait=False, cancel_futures=True)
+            tag_pool = None
+
+def _tag_with_timings(file_path, metadata):
+    """写入标签，返回 (是否成功, 解析并清除旧标签的耗时, 总耗时, 保存方式)"""
+    _stage_clock.marks = {}
+    _tag_save.mode = None
+    start = time.perf_counter()
+    try:
+        success = add_metadata_to_file(file_path, metadata)
+        return success, _stage_clock.marks.get('strip', start) - start, time.perf_counter() - start, _tag_save.mode
+    finally:
+        _stage_clock.marks = None
+
+def tag_file(file_path, metadata):
+    """写入标签，启用进程池时在其他进程中执行，只传回是否成功和耗时"""
+    global tag_pending, tag_pool
+    pool = get_tag_pool()
+    if pool is None:
+        result = _tag_with_timings(file_path, metadata)
+    else:
+        with tag_pool_lock:
+            tag_pending += 1
+        try:
+            result = pool.submit(_tag_with_timings, file_path, metadata).result()
+        except BrokenProcessPool:
+            # 进程意外退出，重建进程池，本次在当前线程中写入
+            logger.error("标签写入进程异常退出，重新创建进程池")
+            with tag_pool_lock:
+                if tag_pool is pool:
+                    tag_pool = None
+            result = _tag_with_timings(file_path, metadata)
+        finally:
+            with tag_pool_lock:
+                tag_pending -= 1
+    
+    success, strip_seconds, total_seconds, save_mode = result
+    file_format = format_label(file_path)
+    metrics.observe_stage('strip', strip_seconds, file_format)
+    metrics.observe_stage('tag', total_seconds - strip_seconds, file_format)
+    if success and save_mode:
+        with tag_pool_lock:
+            tag_saves[save_mode] += 1
+        metrics.inc('metadata_tag_saves_total', format=file_format, mode=save_mode)
+    return success
+
+def get_tag_pool_stats():
+    """返回进程池大小和排队深度"""
+    with tag_pool_lock:
+        return {
+            'processes': TAG_PROCESSES,
+            'pending': tag_pending,
+            'queued': max(0, tag_pending - TAG_PROCESSES) if TAG_PROCESSES > 0 else 0
+        }
+
+class UpstreamReader:
+    """从上游响应按需读取字节，内存占用与文件大小无关"""
+    def __init__(self, response, chunk_size=STREAM_CHUNK_SIZE):
+        self.chunks = response.iter_content(chunk_size=chunk_size)
+        self.chunk_size = chunk_size
+        self.buffer = b''
+    
+    def read(self, size):
+        """读取size字节，到达末尾时可能不足"""
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+    
+    def unread(self, data):
+        self.buffer = data + self.buffer
+    
+    def skip(self, size):
+        """丢弃size字节"""
+        while size > 0:
+            data = self.read(min(size, self.chunk_size))
+            if not data:
+                break
+            size -= len(data)
+    
+    def __iter__(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            yield data
+        for chunk in self.chunks:
+            if chunk:
+                yield chunk
+
+def skip_id3v2(reader):
+    """跳过流开头的所有ID3v2标签"""
     while True:
-        time.sleep(60)
-        if is_shutting_down:
-            break
-            
-        current_time = time.time()
-        files_to_delete = []
-        
-        for file_id, file_info in list(file_registry.items()):
-            if current_time - file_info['created_time'] > FILE_CLEANUP_TIME:
-                files_to_delete.append((file_id, file_info['path']))
-        
-        for file_id, file_path in files_to_delete:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                del file_registry[file_id]
-                logger.info(f"已清理文件: {file_path}")
-            except Exception as e:
-                logger.error(f"清理文件失败: {e}")
+        header = reader.read(10)
+        if len(header) < 10 or header[:3] != b'ID3':
+            reader.unread(header)
+            return
+        size = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f)
+        if header[5] & 0x10:
+            size += 10  # 标签尾
+        reader.skip(size)
 
-@app.route('/process-music', methods=['POST', 'OPTIONS'])
-def process_music():
-    """处理音乐文件"""
-    if is_shutting_down:
-        return jsonify({'error': '服务器正在关闭'}), 503
-        
-    if request.method == 'OPTIONS':
-        return jsonify({'status': 'ok'})
+def build_id3_header(metadata):
+    """在内存中生成新的ID3v2.3标签"""
+    tags = ID3()
+    add_id3_frames(tags, metadata)
+    buffer = io.BytesIO()
+    tags.save(buffer, v2_version=3, padding=lambda info: TAG_PADDING)
+    return buffer.getvalue()
+
+def splice_mp3(reader, metadata):
+    """输出新的ID3标签，跳过源文件的旧标签，音频帧直接透传"""
+    yield build_id3_header(metadata)
+    skip_id3v2(reader)
     
-    try:
-        data = request.get_json()
-        logger.info(f"收到请求")
-        
-        if not data:
-            return jsonify({'error': '无效的JSON数据'}), 400
-        
-        # 验证必需参数
-        required_fields = ['url', 'title']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'缺少必需字段: {field}'}), 400
-        
-        # 生成唯一文件ID
-        file_id = str(uuid.uuid4())
-        url_path = urlparse(data['url']).path
-        original_filename = os.path.basename(url_path) or "audio.mp3"
-        
-        # 文件路径
-        temp_file_path = os.path.join(TEMP_DIR, f"{file_id}_{original_filename}")
-        processed_file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{original_filename}")
-        
-        # 下载原始文件
-        if not download_file(data['url'], temp_file_path):
-            return jsonify({'error': '音乐文件下载失败'}), 500
+    # 保留最后128字节，结束时判断是否为ID3v1标签
+    tail = b''
+    for chunk in reader:
+        tail += chunk
+        if len(tail) > 128:
+            yield tail[:-128]
+            tail = tail[-128:]
+    if tail[:3] != b'TAG':
+        yield tail
+
+def read_flac_header(reader, metadata):
+    """读取源FLAC的元数据块，返回替换标签后的新文件头"""
+    skip_id3v2(reader)
+    if reader.read(4) != b'fLaC':
+        raise ProcessingError('不是有效的FLAC文件')
+    
+    # 保留STREAMINFO、SEEKTABLE等块，丢弃填充、旧注释和旧图片
+    blocks = []
+    while True:
+        header = reader.read(4)
+        if len(header) < 4:
+            raise ProcessingError('FLAC文件头不完整')
+        code = header[0] & 0x7f
+        size = int.from_bytes(header[1:4], 'big')
+        if code in (1, 4, 6):
+            reader.skip(size)
+        else:
+            blocks.append((code, reader.read(size)))
+        if header[0] & 0x80:
+            break
+    
+    comments = VCFLACDict()
+    add_vorbis_comments(comments, metadata)
+    blocks.append((4, comments.write()))
+    if metadata.get('cover_data'):
+        blocks.append((6, build_flac_picture(metadata['cover_data']).write()))
+    if TAG_PADDING > 0:
+        blocks.append((1, bytes(TAG_PADDING)))
+    
+    data = bytearray(b'fLaC')
+    for i, (code, block) in enumerate(blocks):
+        if i == len(blocks) - 1:
+            code |= 0x80
+        data.append(code)
+        data += len(block).to_bytes(3, 'big')
+        data += block
+    return bytes(data)
+
+def stream_track(task):
+    """流式模式：边下载边输出写好标签的文件，不写入磁盘"""
+    file_ext = os.path.splitext(task['filename'])[1].lower()
+    if file_ext not in ('.mp3', '.flac'):
+        raise ProcessingError('流式模式仅支持MP3和FLAC文件', 400)
+    
+    # 封面与音频同时下载
+    cover_future = start_cover_download(task['cover_url']) if task.get('cover_url') else None
+    
+    logger.info(f"开始流式处理: {task['url']}")
+    file_format = format_label(task['filename'])
+    try:
+        start = time.perf_counter()
+        response = get_http_session().get(task['url'], stream=True, headers=DOWNLOAD_HEADERS, timeout=http_timeout())
+        metrics.observe_stage('connect', time.perf_counter() - start, file_format)
+        response.raise_for_status()
+    except Exception as e:
+        if cover_future:
+            cover_future.cancel()
+        logger.error(f"下载失败: {e}")
+        raise ProcessingError('音乐文件下载失败')
+    
+    try:
+        cover_data = wait_cover_download(cover_future) if cover_future else None
+        metadata = dict(task['metadata'], cover_data=cover_data)
+        reader = UpstreamReader(response)
         
-        # 检查文件是否存在且大小合理
-        if not os.path.exists(temp_file_path) or os.path.getsize(temp_file_path) == 0:
-            return jsonify({'error': '下载的文件无效'}), 500
+        if file_ext == '.mp3':
+            body = splice_mp3(reader, metadata)
+        else:
+            with metrics.stage_timer('strip', file_format):
+                header = read_flac_header(reader, metadata)
+            body = itertools.chain([header], reader)
+    except Exception:
+        response.close()
+        raise
+    
+    def generate():
+        try:
+            yield from body
+            logger.info(f"流式处理完成: {task['url']}")
+        finally:
+            response.close()
+    
+    download_name = f"processed_{task['filename']}"
+    return Response(
+        generate(),
+        mimetype=mimetypes.guess_type(task['filename'])[0] or 'application/octet-stream',
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"}
+    )
+
+class ProcessingError(Exception):
+    """处理流程中的可预期错误，携带返回给客户端的HTTP状态码"""
+    def __init__(self, message, status_code=500, headers=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class QuotaExceededError(ProcessingError):
+    """磁盘配额不足，淘汰旧文件后仍无法容纳新任务"""
+    def __init__(self):
+        super().__init__('缓存空间不足，请稍后重试', 503, {'Retry-After': str(QUOTA_RETRY_AFTER)})
+
+class FileRegistry:
+    """线程安全的已处理文件注册表（内存），用最小堆按过期时间索引，按最近下载时间淘汰"""
+    def __init__(self, max_bytes=0):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.entries = OrderedDict()  # 按最近下载时间排序
+        self.expiry_heap = []  # (过期时间, 文件ID)
+        self.total_bytes = 0
+        self.reservations = {}  # 预留令牌 -> 正在处理的文件预留的空间
+        self.reserved_bytes = 0
+        self.max_bytes = max_bytes  # 0表示不限制
+        self.evictions = 0
+        self.rejections = 0
+    
+    def add(self, file_id, file_path, filename, etag=None, ttl=None, reservation=None):
+        """注册文件，处理时预留的空间在注册后转为实际占用"""
+        info = new_file_info(file_path, filename, etag, ttl)
+        with self.lock:
+            self.reserved_bytes -= self.reservations.pop(reservation, 0)
+            old = self.entries.pop(file_id, None)
+            if old:
+                self.total_bytes -= old['size']
+            self.entries[file_id] = info
+            self.total_bytes += info['size']
+            heapq.heappush(self.expiry_heap, (info['expires_time'], file_id))
+            # 新文件比当前等待的更早过期时唤醒清理线程
+            if self.expiry_heap[0][1] == file_id:
+                self.changed.notify_all()
+        return info
+    
+    def get(self, file_id):
+        with self.lock:
+            return self.entries.get(file_id)
+    
+    def touch(self, file_id):
+        """记录下载，最近下载的文件最后被淘汰"""
+        with self.lock:
+            info = self.entries.get(file_id)
+            if info:
+                info['last_access'] = time.time()
+                self.entries.move_to_end(file_id)
+            return info
+    
+    def _evict_for(self, nbytes):
+        """淘汰最久未下载的文件直到能容纳nbytes（调用时需持有锁）"""
+        evicted = []
+        while self.entries and self.total_bytes + self.reserved_bytes + nbytes > self.max_bytes:
+            file_id, info = self.entries.popitem(last=False)
+            self.total_bytes -= info['size']
+            self.evictions += 1
+            evicted.append((file_id, info))
+        return evicted
+    
+    def has_room(self, nbytes):
+        """淘汰全部已完成文件后能否容纳nbytes"""
+        with self.lock:
+            return self.max_bytes <= 0 or self.reserved_bytes + nbytes <= self.max_bytes
+    
+    def reserve(self, nbytes):
+        """为正在处理的文件预留空间，返回(预留令牌, 为此淘汰的条目)；无法容纳时抛出QuotaExceededError"""
+        with self.lock:
+            evicted = []
+            if self.max_bytes > 0:
+                if self.reserved_bytes + nbytes > self.max_bytes:
+                    self.rejections += 1
+                    raise QuotaExceededError()
+                evicted = self._evict_for(nbytes)
+            token = uuid.uuid4().hex
+            self.reservations[token] = nbytes
+            self.reserved_bytes += nbytes
+            return token, evicted
+    
+    def release(self, reservation):
+        with self.lock:
+            self.reserved_bytes -= self.reservations.pop(reservation, 0)
+    
+    def evict_over_budget(self):
+        """超出容量时淘汰最久未下载的文件"""
+        with self.lock:
+            if self.max_bytes <= 0:
+                return []
+            return self._evict_for(0)
+    
+    def __contains__(self, file_id):
+        with self.lock:
+            return file_id in self.entries
+    
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+    
+    def remove(self, file_id):
+        """移除条目并返回其信息，堆中的旧记录在弹出时忽略"""
+        with self.lock:
+            info = self.entries.pop(file_id, None)
+            if info:
+                self.total_bytes -= info['size']
+            return info
+    
+    def pop_expired(self, now=None):
+        """弹出所有已过期的条目，只访问过期部分"""
+        now = now or time.time()
+        expired = []
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                expires_time, file_id = heapq.heappop(self.expiry_heap)
+                info = self.entries.get(file_id)
+                if info is None or info['expires_time'] != expires_time:
+                    continue
+                del self.entries[file_id]
+                self.total_bytes -= info['size']
+                expired.append((file_id, info))
+        return expired
+    
+    def wait_for_expiry(self, max_wait):
+        """等待到下一个文件过期，最多max_wait秒"""
+        with self.lock:
+            timeout = max_wait
+            if self.expiry_heap:
+                timeout = min(max_wait, max(0, self.expiry_heap[0][0] - time.time()))
+            if timeout > 0:
+                self.changed.wait(timeout)
+    
+    def wake(self):
+        with self.lock:
+            self.changed.notify_all()
+    
+    def registered_paths(self):
+        with self.lock:
+            return {info['path'] for info in self.entries.values()}
+    
+    def prune_missing(self):
+        """移除磁盘上已不存在的文件条目"""
+        with self.lock:
+            missing = [file_id for file_id, info in self.entries.items() if not os.path.exists(info['path'])]
+        for file_id in missing:
+            self.remove(file_id)
+        return len(missing)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'files': len(self.entries),
+                'bytes': self.total_bytes,
+                'reserved_bytes': self.reserved_bytes,
+                'max_bytes': self.max_bytes,
+                'usage': round((self.total_bytes + self.reserved_bytes) / self.max_bytes, 4) if self.max_bytes else None,
+                'evictions': self.evictions,
+                'rejections': self.rejections
+            }
+
+class SQLiteFileRegistry:
+    """保存在缓存目录SQLite数据库（WAL模式）中的注册表，重启后保留，可由多个工作进程共享"""
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS files (
+            file_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            created_time REAL NOT NULL,
+            last_access REAL NOT NULL,
+            expires_time REAL NOT NULL,
+            size INTEGER NOT NULL,
+            etag TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS files_expires_time ON files (expires_time)",
+        "CREATE INDEX IF NOT EXISTS files_last_access ON files (last_access)",
+        """CREATE TABLE IF NOT EXISTS reservations (
+            token TEXT PRIMARY KEY,
+            bytes INTEGER NOT NULL,
+            created_time REAL NOT NULL
+        )""",
+        "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+    )
+    
+    def __init__(self, db_path, max_bytes=0):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+    
+    def _conn(self):
+        """每个线程使用自己的连接"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """写事务，多进程之间互斥"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    
+    @staticmethod
+    def _bump(conn, name, delta):
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, delta)
+        )
+    
+    @staticmethod
+    def _counter(conn, name):
+        row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+    
+    @staticmethod
+    def _reserved(conn):
+        """当前有效的预留空间；崩溃进程遗留的预留超时后忽略"""
+        cutoff = time.time() - RESERVATION_MAX_AGE
+        return conn.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE created_time > ?", (cutoff,)
+        ).fetchone()[0]
+    
+    def _delete(self, conn, rows):
+        for row in rows:
+            conn.execute("DELETE FROM files WHERE file_id = ?", (row['file_id'],))
+            self._bump(conn, 'bytes', -row['size'])
+        return [(row['file_id'], dict(row)) for row in rows]
+    
+    def add(self, file_id, file_path, filename, etag=None, ttl=None, reservation=None):
+        """注册文件，处理时预留的空间在注册后转为实际占用"""
+        info = new_file_info(file_path, filename, etag, ttl)
+        with self._transaction() as conn:
+            if reservation:
+                conn.execute("DELETE FROM reservations WHERE token = ?", (reservation,))
+            self._delete(conn, conn.execute("SELECT * FROM files WHERE file_id = ?", (file_id,)).fetchall())
+            conn.execute(
+                "INSERT INTO files (file_id, path, filename, created_time, last_access, expires_time, size, etag) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_id, info['path'], info['filename'], info['created_time'], info['last_access'],
+                 info['expires_time'], info['size'], info['etag'])
+            )
+            self._bump(conn, 'bytes', info['size'])
+        self.wake()
+        return info
+    
+    def get(self, file_id):
+        row = self._conn().execute("SELECT * FROM files WHERE file_id = ?", (file_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def touch(self, file_id):
+        """记录下载，最近下载的文件最后被淘汰"""
+        self._conn().execute("UPDATE files SET last_access = ? WHERE file_id = ?", (time.time(), file_id))
+        return self.get(file_id)
+    
+    def _evict_for(self, conn, nbytes):
+        """淘汰最久未下载的文件直到能容纳nbytes（在事务中调用）"""
+        evicted = []
+        reserved = self._reserved(conn)
+        while self._counter(conn, 'bytes') + reserved + nbytes > self.max_bytes:
+            rows = conn.execute("SELECT * FROM files ORDER BY last_access LIMIT 1").fetchall()
+            if not rows:
+                break
+            evicted += self._delete(conn, rows)
+            self._bump(conn, 'evictions', 1)
+        return evicted
+    
+    def has_room(self, nbytes):
+        """淘汰全部已完成文件后能否容纳nbytes"""
+        return self.max_bytes <= 0 or self._reserved(self._conn()) + nbytes <= self.max_bytes
+    
+    def reserve(self, nbytes):
+        """为正在处理的文件预留空间，返回(预留令牌, 为此淘汰的条目)；无法容纳时抛出QuotaExceededError"""
+        token = uuid.uuid4().hex
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM reservations WHERE created_time <= ?", (time.time() - RESERVATION_MAX_AGE,))
+            evicted = []
+            if self.max_bytes > 0:
+                if self._reserved(conn) + nbytes > self.max_bytes:
+                    self._bump(conn, 'rejections', 1)
+                    rejected = True
+                else:
+                    rejected = False
+                    evicted = self._evict_for(conn, nbytes)
+            else:
+                rejected = False
+            if not rejected:
+                conn.execute(
+                    "INSERT INTO reservations (token, bytes, created_time) VALUES (?, ?, ?)",
+                    (token, nbytes, time.time())
+                )
+        if rejected:
+            raise QuotaExceededError()
+        return token, evicted
+    
+    def release(self, reservation):
+        if reservation:
+            self._conn().execute("DELETE FROM reservations WHERE token = ?", (reservation,))
+    
+    def evict_over_budget(self):
+        """超出容量时淘汰最久未下载的文件"""
+        if self.max_bytes <= 0:
+            return []
+        with self._transaction() as conn:
+            return self._evict_for(conn, 0)
+    
+    def __contains__(self, file_id):
+        return self.get(file_id) is not None
+    
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    
+    def remove(self, file_id):
+        with self._transaction() as conn:
+            removed = self._delete(conn, conn.execute("SELECT * FROM files WHERE file_id = ?", (file_id,)).fetchall())
+        return removed[0][1] if removed else None
+    
+    def pop_expired(self, now=None):
+        """弹出所有已过期的条目，通过过期时间索引只访问过期部分"""
+        now = now or time.time()
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT * FROM files WHERE expires_time <= ?", (now,)).fetchall()
+            return self._delete(conn, rows)
+    
+    def wait_for_expiry(self, max_wait):
+        """等待到下一个文件过期，最多max_wait秒"""
+        next_expiry = self._conn().execute("SELECT MIN(expires_time) FROM files").fetchone()[0]
+        timeout = max_wait
+        if next_expiry is not None:
+            timeout = min(max_wait, max(0, next_expiry - time.time()))
+        if timeout > 0:
+            with self.lock:
+                self.changed.wait(timeout)
+    
+    def wake(self):
+        with self.lock:
+            self.changed.notify_all()
+    
+    def registered_paths(self):
+        return {row[0] for row in self._conn().execute("SELECT path FROM files")}
+    
+    def prune_missing(self):
+        """移除磁盘上已不存在的文件条目"""
+        rows = self._conn().execute("SELECT file_id, path FROM files").fetchall()
+        missing = [row['file_id'] for row in rows if not os.path.exists(row['path'])]
+        for file_id in missing:
+            self.remove(file_id)
+        return len(missing)
+    
+    def stats(self):
+        conn = self._conn()
+        reserved = self._reserved(conn)
+        total = self._counter(conn, 'bytes')
+        return {
+            'backend': 'sqlite',
+            'files': len(self),
+            'bytes': total,
+            'reserved_bytes': reserved,
+            'max_bytes': self.max_bytes,
+            'usage': round((total + reserved) / self.max_bytes, 4) if self.max_bytes else None,
+            'evictions': self._counter(conn, 'evictions'),
+            'rejections': self._counter(conn, 'rejections')
+        }
+
+def new_file_info(file_path, filename, etag=None, ttl=None):
+    """生成注册表条目"""
+    now = time.time()
+    return {
+        'path': file_path,
+        'filename': filename,
+        'created_time': now,
+        'last_access': now,
+        'expires_time': now + (ttl if ttl is not None else FILE_CLEANUP_TIME),
+        'size': os.path.getsize(file_path),
+        'etag': etag
+    }
+
+def create_file_registry():
+    """根据配置创建注册表"""
+    if REGISTRY_BACKEND == 'sqlite':
+        try:
+            return SQLiteFileRegistry(os.path.join(TEMP_DIR, 'file_registry.db'), OUTPUT_MAX_BYTES)
+        except Exception as e:
+            logger.error(f"打开SQLite注册表失败，改用内存注册表: {e}")
+    # 内存注册表在同一进程内重启服务器时保留原有条目
+    if isinstance(file_registry, FileRegistry):
+        file_registry.max_bytes = OUTPUT_MAX_BYTES
+        return file_registry
+    return FileRegistry(OUTPUT_MAX_BYTES)
+
+def remove_file(file_path):
+    """删除已处理的文件"""
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        logger.info(f"已清理文件: {file_path}")
+    except Exception as e:
+        logger.error(f"清理文件失败: {e}")
+
+def cleanup_orphan_files():
+    """清理不在注册表中的遗留文件（崩溃或重启前留下的）"""
+    pruned = file_registry.prune_missing()
+    if pruned:
+        logger.info(f"已移除 {pruned} 个文件已丢失的注册条目")
+    
+    known = file_registry.registered_paths()
+    # 其他工作进程可能正在处理，只清理一段时间未修改的文件
+    cutoff = time.time() - ORPHAN_GRACE_TIME
+    for name in os.listdir(TEMP_DIR):
+        if not (name.startswith('processed_') or name.startswith('staging_')):
+            continue
+        path = os.path.join(TEMP_DIR, name)
+        try:
+            if path in known or os.path.getmtime(path) > cutoff:
+                continue
+        except OSError:
+            continue
+        remove_file(path)
+
+def reserve_output_space(nbytes):
+    """预留磁盘空间，删除为此淘汰的文件，返回预留令牌"""
+    token, evicted = file_registry.reserve(nbytes)
+    for file_id, file_info in evicted:
+        logger.info(f"磁盘配额已满，淘汰文件: {file_id}")
+        remove_file(file_info['path'])
+    return token
+
+def cleanup_old_files():
+    """文件到期时立即清理，同时定期清理已结束的任务和遗留文件"""
+    last_orphan_scan = time.time()
+    while not is_shutting_down:
+        file_registry.wait_for_expiry(60)
+        if is_shutting_down:
+            break
         
-        # 下载封面
-        cover_data = None
-        if data.get('cover_url'):
-            cover_data = download_cover(data['cover_url'])
+        try:
+            for file_id, file_info in file_registry.pop_expired():
+                remove_file(file_info['path'])
+            
+            if time.time() - last_orphan_scan > ORPHAN_GRACE_TIME:
+                last_orphan_scan = time.time()
+                cleanup_orphan_files()
+        except Exception as e:
+            logger.error(f"清理文件失败: {e}")
         
-        # 准备元数据
-        metadata = {
+        # 清理已结束的过期任务
+        current_time = time.time()
+        with job_lock:
+            for job_id, job in list(job_registry.items()):
+                if job['finished_time'] and current_time - job['finished_time'] > FILE_CLEANUP_TIME:
+                    del job_registry[job_id]
+
+file_registry = FileRegistry(OUTPUT_MAX_BYTES)
+
+def _noop_progress(stage, state, **info):
+    pass
+
+def parse_process_request(data):
+    """校验请求数据并生成处理任务"""
+    if not data:
+        raise ProcessingError('无效的JSON数据', 400)
+    
+    # 验证必需参数
+    required_fields = ['url', 'title']
+    for field in required_fields:
+        if field not in data:
+            raise ProcessingError(f'缺少必需字段: {field}', 400)
+    
+    url_path = urlparse(data['url']).path
+    original_filename = os.path.basename(url_path) or "audio.mp3"
+    
+    task = {
+        'url': data['url'],
+        'cover_url': data.get('cover_url'),
+        'filename': original_filename,
+        'metadata': {
             'title': data['title'],
             'artist': data.get('artist', ''),
             'album': data.get('album', ''),
             'year': data.get('year', ''),
             'lyrics': data.get('lyrics', ''),
-            'tips': data.get('tips', ''),
-            'cover_data': cover_data
+            'tips': data.get('tips', '')
         }
+    }
+    task['fingerprint'] = request_fingerprint(task)
+    return task
+
+def metadata_fingerprint(metadata, cover_url=None):
+    """规范化元数据后计算哈希"""
+    normalized = {key: str(value).strip() for key, value in metadata.items() if key != 'cover_data'}
+    normalized['cover_url'] = (cover_url or '').strip()
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def request_fingerprint(task):
+    """请求指纹：源URL + 元数据哈希，相同指纹的请求产生相同的文件"""
+    return hashlib.sha256(
+        f"{task['url'].strip()}\n{metadata_fingerprint(task['metadata'], task.get('cover_url'))}".encode('utf-8')
+    ).hexdigest()
+
+def process_track_coalesced(task, progress=None):
+    """相同的请求同时到达时只处理一次，其余请求等待并得到相同的文件ID"""
+    global coalesced_requests
+    key = task['fingerprint']
+    with inflight_lock:
+        flight = inflight_requests.get(key)
+        if flight is None:
+            flight = inflight_requests[key] = {'event': threading.Event(), 'file_id': None, 'error': None}
+            leader = True
+        else:
+            coalesced_requests += 1
+            leader = False
+    if not leader:
+        metrics.inc('metadata_coalesced_requests_total')
+    
+    if not leader:
+        logger.info("相同请求正在处理，等待其结果")
+        if progress:
+            for stage in JOB_STAGES:
+                progress(stage, 'coalesced')
+        flight['event'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        if progress:
+            for stage in JOB_STAGES:
+                progress(stage, 'done')
+        return flight['file_id']
+    
+    try:
+        flight['file_id'] = process_track(task, progress)
+        return flight['file_id']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with inflight_lock:
+            inflight_requests.pop(key, None)
+        flight['event'].set()
+
+class OutputCache:
+    """处理结果缓存：以源文件内容哈希加元数据哈希为键，有独立的有效期和容量"""
+    def __init__(self, cache_dir, max_bytes, ttl):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 键 -> {'size', 'etag', 'created'}，按最近使用排序
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+    
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+    
+    @staticmethod
+    def make_key(source_hash, task):
+        return hashlib.sha256(
+            f"{source_hash}\n{metadata_fingerprint(task['metadata'], task.get('cover_url'))}\n{cover_variant()}".encode('utf-8')
+        ).hexdigest()
+    
+    def _load_index(self):
+        """读取索引，丢弃已过期或已不存在的缓存文件"""
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except Exception as e:
+            logger.warning(f"读取结果缓存索引失败: {e}")
+            return
         
-        # 复制文件到新路径
-        shutil.copy2(temp_file_path, processed_file_path)
+        now = time.time()
+        for key, entry in index.get('entries', []):
+            path = self.entry_path(key)
+            if now - entry['created'] < self.ttl and os.path.exists(path):
+                self.entries[key] = entry
+                self.total_bytes += entry['size']
+            elif os.path.exists(path):
+                os.remove(path)
+        self._evict()
+    
+    def _save_index(self):
+        """保存索引（调用时需持有锁）"""
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': list(self.entries.items())}, f)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.warning(f"保存结果缓存索引失败: {e}")
+    
+    def _drop(self, key):
+        """删除缓存条目（调用时需持有锁）"""
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+        try:
+            os.remove(self.entry_path(key))
+        except OSError as e:
+            logger.warning(f"删除结果缓存文件失败: {e}")
+    
+    def _evict(self):
+        """按最近最少使用淘汰，直到不超过容量（调用时需持有锁）"""
+        while self.total_bytes > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+    
+    def lookup(self, task, source_hash):
+        """按上游当前内容的哈希查找缓存的处理结果，返回 (路径, 大小, ETag) 或None"""
+        with self.lock:
+            key = self.make_key(source_hash, task) if source_hash else None
+            entry = self.entries.get(key) if key else None
+            if entry and time.time() - entry['created'] >= self.ttl:
+                self._drop(key)
+                self._save_index()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entry_path(key), entry['size'], entry['etag']
+    
+    def store(self, task, source_hash, file_path, etag):
+        """保存处理结果，优先使用硬链接避免复制"""
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            return
+        key = self.make_key(source_hash, task)
+        tmp_path = self.entry_path(key) + f'.{uuid.uuid4().hex}.tmp'
+        link_or_copy(file_path, tmp_path)
+        os.replace(tmp_path, self.entry_path(key))
         
-        # 清理原始文件
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)['size']
+            self.entries[key] = {'size': size, 'etag': etag, 'created': time.time()}
+            self.total_bytes += size
+            self._evict()
+            self._save_index()
+    
+    def report(self):
+        """返回缓存使用情况与命中统计"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions
+            }
+
+def link_or_copy(src, dst):
+    """创建硬链接，文件系统不支持时复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def serve_cached_output(task, progress):
+    """命中结果缓存时直接注册缓存的文件，返回文件ID；未命中返回None"""
+    # 只有上游确认内容未变化（304）时才能使用缓存的结果，无法验证时按正常流程处理
+    source_hash = source_cache.current_hash(task['url']) if source_cache is not None else None
+    cached = output_cache.lookup(task, source_hash)
+    if cached is None:
+        return None
+    cached_path, size, etag = cached
+    
+    file_id = str(uuid.uuid4())
+    processed_file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{task['filename']}")
+    reservation = reserve_output_space(size)
+    try:
+        link_or_copy(cached_path, processed_file_path)
+    except OSError as e:
+        # 缓存文件刚被淘汰，按正常流程处理
+        logger.warning(f"读取结果缓存失败: {e}")
+        file_registry.release(reservation)
+        return None
+    
+    register_file(file_id, processed_file_path, task['filename'], reservation, etag=etag)
+    logger.info(f"结果缓存命中: {task['url']}")
+    for stage in JOB_STAGES:
+        progress(stage, 'cached')
+    metrics.inc('metadata_tracks_total', format=format_label(task['filename']), result='cached')
+    return file_id
+
+def process_track(task, progress=None):
+    """执行 下载 → 写入标签 → 注册 的完整流程，返回文件ID"""
+    progress = progress or _noop_progress
+    
+    # 相同的源文件和元数据之前处理过时直接返回
+    if output_cache is not None:
+        file_id = serve_cached_output(task, progress)
+        if file_id:
+            return file_id
+    
+    # 生成唯一文件ID
+    file_id = str(uuid.uuid4())
+    original_filename = task['filename']
+    file_format = format_label(original_filename)
+    
+    # 文件路径：音频只写入一次暂存文件，写好标签后再原子重命名为最终文件
+    staging_file_path = os.path.join(TEMP_DIR, f"staging_{file_id}_{original_filename}")
+    processed_file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{original_filename}")
+    
+    # 预留磁盘空间，淘汰旧文件后仍不足时拒绝
+    reservation = reserve_output_space(OUTPUT_RESERVE_BYTES)
+    registered = False
+    
+    # 封面与音频同时下载（批量处理时共用的封面已提前下载）
+    cover_future = None
+    if 'cover_data' in task:
+        progress('cover', 'done' if task['cover_data'] else 'failed')
+    elif task.get('cover_url'):
+        progress('cover', 'running')
+        cover_future = start_cover_download(task['cover_url'])
+    else:
+        progress('cover', 'skipped')
+    
+    try:
+        # 下载原始文件
+        progress('download', 'running')
+        with metrics.stage_timer('download', file_format):
+            fetched = fetch_source(task['url'], staging_file_path,
+                                   progress=lambda done, total: progress('download', 'running', bytes=done, total=total))
+        if not fetched:
+            progress('download', 'failed')
+            raise ProcessingError('音乐文件下载失败')
+        
+        # 检查文件是否存在且大小合理
+        if not os.path.exists(staging_file_path) or os.path.getsize(staging_file_path) == 0:
+            progress('download', 'failed')
+            raise ProcessingError('下载的文件无效')
+        progress('download', 'done')
+        source_hash = file_sha256(staging_file_path) if output_cache is not None else None
+        
+        # 按实际大小调整预留空间
+        file_registry.release(reservation)
+        reservation = None
+        reservation = reserve_output_space(os.path.getsize(staging_file_path))
+        
+        # 等待封面下载完成，失败时不添加封面
+        cover_data = task.get('cover_data')
+        if cover_future:
+            cover_data = wait_cover_download(cover_future)
+            cover_future = None
+            progress('cover', 'done' if cover_data else 'failed')
+        
+        # 准备元数据
+        metadata = dict(task['metadata'], cover_data=cover_data)
         
         # 添加元数据
         logger.info("开始添加元数据")
-        if not add_metadata_to_file(processed_file_path, metadata):
-            if os.path.exists(processed_file_path):
-                os.remove(processed_file_path)
-            return jsonify({'error': '添加元数据失败，可能是不支持的文件格式'}), 500
-        
-        # 注册文件
-        file_registry[file_id] = {
-            'path': processed_file_path,
-            'filename': original_filename,
-            'created_time': time.time()
-        }
+        progress('tagging', 'running')
+        if not tag_file(staging_file_path, metadata):
+            progress('tagging', 'failed')
+            raise ProcessingError('添加元数据失败，可能是不支持的文件格式')
+        progress('tagging', 'done')
+        
+        os.replace(staging_file_path, processed_file_path)
+        info = register_file(file_id, processed_file_path, original_filename, reservation)
+        registered = True
+        
+        if output_cache is not None:
+            try:
+                output_cache.store(task, source_hash, processed_file_path, info['etag'])
+            except Exception as e:
+                logger.warning(f"保存结果缓存失败: {e}")
+    
+    finally:
+        if cover_future:
+            cover_future.cancel()
+        if not registered:
+            file_registry.release(reservation)
+        metrics.inc('metadata_tracks_total', format=file_format, result='success' if registered else 'failure')
+        # 失败时不留下未完成的文件
+        if os.path.exists(staging_file_path):
+            try:
+                os.remove(staging_file_path)
+            except OSError as e:
+                logger.warning(f"删除暂存文件失败: {e}")
+    
+    return file_id
+
+def register_file(file_id, file_path, filename, reservation=None, etag=None):
+    """注册可下载的文件，ETag由文件内容生成；超出磁盘配额时淘汰最久未下载的文件"""
+    info = file_registry.add(file_id, file_path, filename, etag=etag or file_sha256(file_path), reservation=reservation)
+    for old_id, old_info in file_registry.evict_over_budget():
+        if old_id != file_id:
+            logger.info(f"磁盘配额已满，淘汰文件: {old_id}")
+            remove_file(old_info['path'])
+    return info
+
+def _job_progress(job):
+    """生成更新任务阶段进度的回调"""
+    def progress(stage, state, **info):
+        stage_info = job['stages'].setdefault(stage, {})
+        stage_info['state'] = state
+        stage_info.update(info)
+    return progress
+
+def _run_job(job_id):
+    """在工作线程中执行异步任务"""
+    with job_lock:
+        job = job_registry.get(job_id)
+        if job is None:
+            return
+        job['state'] = 'running'
+        job['started_time'] = time.time()
+    
+    session = profiler.begin() if profiler is not None else None
+    try:
+        file_id = process_track_coalesced(job['task'], _job_progress(job))
+        job['file_id'] = file_id
+        job['download_url'] = f"http://{job['host']}/download/{file_id}"
+        job['state'] = 'succeeded'
+        logger.info(f"任务完成: {job_id}")
+    except ProcessingError as e:
+        job['error'] = e.message
+        job['state'] = 'failed'
+        logger.error(f"任务失败: {job_id}, {e.message}")
+    except Exception as e:
+        job['error'] = f'服务器内部错误: {str(e)}'
+        job['state'] = 'failed'
+        logger.error(f"任务执行时发生错误: {e}")
+        logger.error(traceback.format_exc())
+    finally:
+        job['finished_time'] = time.time()
+        if session is not None:
+            profiler.end(session, f"job {job_id}")
+
+def new_job(task, host):
+    """创建并登记异步任务（调用时需持有job_lock）"""
+    job_id = str(uuid.uuid4())
+    job_registry[job_id] = {
+        'job_id': job_id,
+        'state': 'queued',
+        'task': task,
+        'host': host,
+        'stages': {stage: {'state': 'pending'} for stage in JOB_STAGES},
+        'created_time': time.time(),
+        'started_time': None,
+        'finished_time': None,
+        'file_id': None,
+        'download_url': None,
+        'error': None
+    }
+    return job_registry[job_id]
+
+def job_snapshot(job):
+    """任务状态的JSON表示"""
+    return {
+        'job_id': job['job_id'],
+        'state': job['state'],
+        'stages': job['stages'],
+        'created_time': job['created_time'],
+        'started_time': job['started_time'],
+        'finished_time': job['finished_time'],
+        'file_id': job['file_id'],
+        'download_url': job['download_url'],
+        'error': job['error']
+    }
+
+def submit_job(task, host, launch=None):
+    """提交异步处理任务，队列已满时返回None；相同的任务未完成时返回已有任务ID
+    
+    launch为None时由工作线程池执行，否则调用launch(job)启动任务（asyncio模式）
+    """
+    global job_executor, coalesced_requests
+    with job_lock:
+        pending = [job for job in job_registry.values() if job['state'] in ('queued', 'running')]
+        for job in pending:
+            if job['task']['fingerprint'] == task['fingerprint']:
+                coalesced_requests += 1
+                metrics.inc('metadata_coalesced_requests_total')
+                logger.info(f"相同任务正在处理: {job['job_id']}")
+                return job['job_id']
+        if len(pending) >= JOB_WORKERS + JOB_QUEUE_SIZE:
+            return None
+        
+        if job_executor is None and launch is None:
+            job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job-worker')
+        
+        job = new_job(task, host)
+    
+    if launch is None:
+        job_executor.submit(_run_job, job['job_id'])
+    else:
+        launch(job)
+    logger.info(f"任务已提交: {job['job_id']}")
+    return job['job_id']
+
+@app.route('/process-music', methods=['POST', 'OPTIONS'])
+def process_music():
+    """处理音乐文件"""
+    if is_shutting_down:
+        return jsonify({'error': '服务器正在关闭'}), 503
+        
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
+    
+    try:
+        data = request.get_json()
+        logger.info(f"收到请求")
+        
+        task = parse_process_request(data)
+        mode = request.args.get('mode') or data.get('mode', 'sync')
+        
+        # 流式模式：直接返回写好标签的文件内容
+        if mode == 'stream':
+            return stream_track(task)
+        
+        # 异步模式：立即返回任务ID，由工作线程池执行处理流程
+        if mode == 'async':
+            if not file_registry.has_room(OUTPUT_RESERVE_BYTES):
+                raise QuotaExceededError()
+            job_id = submit_job(task, request.host)
+            if job_id is None:
+                return jsonify({'error': '任务队列已满，请稍后重试'}), 503
+            return jsonify({
+                'success': True,
+                'job_id': job_id,
+                'status_url': f"http://{request.host}/jobs/{job_id}",
+                'message': '任务已提交'
+            }), 202
+        
+        file_id = process_track_coalesced(task)
         
         download_url = f"http://{request.host}/download/{file_id}"
         return jsonify({
@@ -548,39 +2730,293 @@ def process_music():
             'message': '文件处理成功'
         })
     
+    except ProcessingError as e:
+        return jsonify({'error': e.message}), e.status_code, e.headers
+    
     except Exception as e:
         logger.error(f"处理请求时发生错误: {e}")
         logger.error(traceback.format_exc())
         return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
 
-@app.route('/download/<file_id>')
-def download_file_endpoint(file_id):
-    """下载文件"""
+def build_archive(results, archive_name):
+    """把批量处理成功的文件打包为zip并注册，返回 (文件ID, 未能打包的歌曲序号)
+    
+    本批次的文件可能在处理其他歌曲时已被淘汰，这些歌曲会被跳过；
+    没有可打包的文件时文件ID为None，配额容纳不下压缩包时抛出QuotaExceededError
+    """
+    # 先标记为最近下载，预留空间时最后才淘汰本批次的文件
+    size = 0
+    for result in results:
+        file_info = file_registry.touch(result['file_id']) if result['success'] else None
+        if file_info:
+            # 仅存储不压缩，每个文件另加目录项的开销
+            size += file_info['size'] + 1024
+    # 配额需要同时容纳本批次的文件和压缩包，否则预留空间时会淘汰掉要打包的文件
+    if not file_registry.has_room(size * 2):
+        raise QuotaExceededError()
+    
+    file_id = str(uuid.uuid4())
+    archive_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{archive_name}")
+    staging_path = os.path.join(TEMP_DIR, f"staging_{file_id}_{archive_name}")
+    reservation = reserve_output_space(size)
+    skipped = []
+    archived = 0
+    try:
+        # 音频已是压缩格式，直接存储不再压缩
+        with zipfile.ZipFile(staging_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for result in results:
+                if not result['success']:
+                    continue
+                file_info = file_registry.get(result['file_id'])
+                try:
+                    if file_info is None:
+                        raise FileNotFoundError(result['file_id'])
+                    archive.write(file_info['path'], f"{result['index'] + 1:02d}_{file_info['filename']}")
+                    archived += 1
+                except OSError:
+                    logger.warning(f"文件已被淘汰，未打包: {result['file_id']}")
+                    skipped.append(result['index'])
+        if archived:
+            os.replace(staging_path, archive_path)
+    except Exception:
+        file_registry.release(reservation)
+        raise
+    finally:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+    
+    if not archived:
+        file_registry.release(reservation)
+        return None, skipped
+    register_file(file_id, archive_path, archive_name, reservation)
+    return file_id, skipped
+
+@app.route('/process-batch', methods=['POST', 'OPTIONS'])
+def process_batch():
+    """批量处理整张专辑或歌单，共用的封面只下载一次"""
+    global batch_executor
     if is_shutting_down:
         return jsonify({'error': '服务器正在关闭'}), 503
+    
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
+    
+    try:
+        data = request.get_json()
+        logger.info("收到批量请求")
+        
+        if not data or not isinstance(data.get('tracks'), list) or not data['tracks']:
+            return jsonify({'error': '缺少必需字段: tracks'}), 400
+        if len(data['tracks']) > MAX_BATCH_TRACKS:
+            return jsonify({'error': f'单次最多处理 {MAX_BATCH_TRACKS} 首歌曲'}), 400
+        
+        # 专辑级字段作为每首歌曲的默认值
+        shared = {field: data[field] for field in BATCH_SHARED_FIELDS if data.get(field)}
+        tasks = []
+        for index, track in enumerate(data['tracks']):
+            if not isinstance(track, dict):
+                return jsonify({'error': f'第 {index + 1} 首歌曲数据无效'}), 400
+            try:
+                tasks.append(parse_process_request(dict(shared, **track)))
+            except ProcessingError as e:
+                return jsonify({'error': f'第 {index + 1} 首歌曲: {e.message}'}), e.status_code, e.headers
+        
+        # 共用的封面只下载一次
+        shared_cover_url = shared.get('cover_url')
+        if shared_cover_url:
+            cover_data = wait_cover_download(start_cover_download(shared_cover_url))
+            for task in tasks:
+                if task.get('cover_url') == shared_cover_url:
+                    task['cover_data'] = cover_data
+        
+        with batch_executor_lock:
+            if batch_executor is None:
+                batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch-worker')
+        
+        def run(index, task):
+            try:
+                return {'index': index, 'success': True, 'file_id': process_track_coalesced(task)}
+            except ProcessingError as e:
+                return {'index': index, 'success': False, 'error': e.message}
+            except Exception as e:
+                logger.error(f"批量处理第 {index + 1} 首时发生错误: {e}")
+                logger.error(traceback.format_exc())
+                return {'index': index, 'success': False, 'error': f'服务器内部错误: {str(e)}'}
+        
+        host = request.host
+        futures = [batch_executor.submit(run, index, task) for index, task in enumerate(tasks)]
+        results = [future.result() for future in futures]
+        for result in results:
+            if result['success']:
+                result['download_url'] = f"http://{host}/download/{result['file_id']}"
+        succeeded = sum(1 for result in results if result['success'])
         
-    if file_id not in file_registry:
+        response = {
+            'success': succeeded == len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'results': results
+        }
+        
+        # 可选：打包为一个zip下载
+        if data.get('archive') and succeeded:
+            archive_name = f"{data.get('album') or 'batch'}.zip".replace('/', '_').replace('\\', '_')
+            try:
+                archive_id, skipped = build_archive(results, archive_name)
+            except ProcessingError as e:
+                archive_id, skipped = None, []
+                response['archive_error'] = e.message
+            if archive_id:
+                response['archive_file_id'] = archive_id
+                response['archive_url'] = f"http://{host}/download/{archive_id}"
+            elif 'archive_error' not in response:
+                response['archive_error'] = '文件已被淘汰，无法打包'
+            if skipped:
+                # 已被淘汰而未能打包的歌曲在results中的序号
+                response['archive_skipped'] = skipped
+        
+        return jsonify(response)
+    
+    except Exception as e:
+        logger.error(f"处理批量请求时发生错误: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """查询异步任务状态"""
+    job = job_registry.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    
+    return jsonify(job_snapshot(job))
+
+@app.route('/download/<file_id>')
+def download_file_endpoint(file_id):
+    """下载文件（关闭过程中仍可下载已完成的文件）"""
+    start = time.perf_counter()
+    file_info = file_registry.touch(file_id)
+    if file_info is None:
         return jsonify({'error': '文件不存在或已过期'}), 404
     
-    file_info = file_registry[file_id]
     if not os.path.exists(file_info['path']):
         return jsonify({'error': '文件不存在'}), 404
     
-    return send_file(
+    download_name = f"processed_{file_info['filename']}"
+    etag = file_info.get('etag')
+    
+    # 多段Range请求返回multipart/byteranges
+    if request.range and len(request.range.ranges) > 1 and etag:
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': f'"{etag}"'})
+        if if_range_matches(request.if_range, etag, file_info['path']):
+            return track_serve(send_multirange(file_info['path'], request.range, etag, download_name),
+                               file_info['filename'], start)
+    
+    # If-Range不匹配时send_file忽略Range返回完整内容；单段Range、If-None-Match/If-Range由send_file处理；
+    # 服务器支持wsgi.file_wrapper时使用sendfile，启用use_x_sendfile时交给前置服务器
+    response = send_file(
         file_info['path'],
         as_attachment=True,
-        download_name=f"processed_{file_info['filename']}"
+        download_name=download_name,
+        etag=etag if etag else True,
+        conditional=True
     )
+    return track_serve(response, file_info['filename'], start)
+
+def track_serve(response, filename, start):
+    """记录准备响应的耗时和要发送的字节数；
+    文件内容由服务器直接发送（可能使用sendfile），发送过程不计入耗时"""
+    file_format = format_label(filename)
+    metrics.observe_stage('serve', time.perf_counter() - start, file_format)
+    metrics.inc('metadata_bytes_out_total', response.content_length or 0, format=file_format)
+    return response
+
+def if_range_matches(if_range, etag, file_path):
+    """If-Range为空或与文件的ETag/修改时间一致时返回True，此时按Range返回（Last-Modified精确到秒）"""
+    if if_range.date:
+        return int(os.path.getmtime(file_path)) <= if_range.date.timestamp()
+    return not if_range.etag or if_range.etag == etag
+
+def satisfiable_ranges(byte_range, length):
+    """把Range请求头中的各段换算为 [(起始, 结束)) 列表，去掉无法满足的段"""
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        else:
+            stop = min(stop or length, length)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+def multipart_body(file_path, ranges, length, mimetype):
+    """生成multipart/byteranges内容，返回 (分隔符, 内容长度, 内容生成器)"""
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n").encode('ascii')
+        for start, stop in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode('ascii')
+    content_length = sum(len(h) + (stop - start) for h, (start, stop) in zip(part_headers, ranges))
+    content_length += 2 * (len(ranges) - 1) + len(closing)
+    
+    def generate():
+        with open(file_path, 'rb') as f:
+            for i, (header, (start, stop)) in enumerate(zip(part_headers, ranges)):
+                if i:
+                    yield b'\r\n'
+                yield header
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(remaining, STREAM_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+        yield closing
+    
+    return boundary, content_length, generate()
+
+def send_multirange(file_path, byte_range, etag, download_name):
+    """按RFC 7233返回多段Range响应"""
+    length = os.path.getsize(file_path)
+    ranges = satisfiable_ranges(byte_range, length)
+    if not ranges:
+        return Response(status=416, headers={'Content-Range': f'bytes */{length}'})
+    if len(ranges) > MAX_DOWNLOAD_RANGES:
+        response = jsonify({'error': 'Range段数过多'})
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{length}'
+        return response
+    
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    boundary, content_length, chunks = multipart_body(file_path, ranges, length, mimetype)
+    response = Response(chunks, status=206, mimetype=f'multipart/byteranges; boundary={boundary}')
+    response.content_length = content_length
+    response.set_etag(etag)
+    response.last_modified = int(os.path.getmtime(file_path))
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+    return response
+
+def file_sha256(file_path):
+    """计算文件内容的SHA-256"""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
-    """关闭服务器"""
+    """关闭服务器：不再接收新任务，进行中的任务完成后停止"""
     global is_shutting_down
-    is_shutting_down = True
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError('Not running with the Werkzeug Server')
-    func()
+    if not is_shutting_down:
+        is_shutting_down = True
+        threading.Thread(target=stop_server, daemon=True).start()
     return jsonify({'status': 'shutting_down', 'message': '服务器正在关闭'})
 
 @app.route('/status')
@@ -588,7 +3024,93 @@ def status():
     """返回服务器状态"""
     if is_shutting_down:
         return jsonify({'status': 'shutting_down'}), 503
-    return jsonify({'status': 'success', 'message': '服务器运行正常'})
+    return jsonify(server_status())
+
+@app.before_request
+def begin_request_profile():
+    if profiler is not None and not request.path.startswith('/debug/'):
+        g.profile_session = profiler.begin()
+
+@app.teardown_request
+def end_request_profile(exc):
+    session = g.pop('profile_session', None)
+    if session is not None:
+        profiler.end(session, f"{request.method} {request.full_path.rstrip('?')}")
+
+@app.route('/debug/profiles')
+def list_profiles():
+    """列出保存的性能分析结果"""
+    if profiler is None:
+        return jsonify({'error': '性能分析未启用'}), 404
+    return jsonify({'profiles': profiler.entries()})
+
+@app.route('/debug/profiles/<profile_id>')
+def get_profile(profile_id):
+    """返回分析报告；format=pstats时返回可用snakeviz等工具查看的cProfile数据"""
+    if profiler is None:
+        return jsonify({'error': '性能分析未启用'}), 404
+    
+    if request.args.get('format') == 'pstats':
+        path = profiler.path(profile_id, '.prof')
+        if path is None:
+            return jsonify({'error': '分析结果不存在'}), 404
+        return send_file(path, as_attachment=True, download_name=f"{profile_id}.prof")
+    
+    path = profiler.path(profile_id)
+    if path is None:
+        return jsonify({'error': '分析结果不存在'}), 404
+    with open(path, 'r', encoding='utf-8') as f:
+        entry = json.load(f)
+    header = f"{entry['request']}  耗时 {entry['duration']}秒  ({entry['kind']})\n\n"
+    return Response(header + entry['report'], content_type='text/plain; charset=utf-8')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus文本格式的监控指标"""
+    return Response(metrics.render(metric_gauges()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def metric_gauges():
+    """采集当前的任务数、注册表和缓存大小"""
+    with job_lock:
+        active_jobs = sum(1 for job in job_registry.values() if job['state'] in ('queued', 'running'))
+    with inflight_lock:
+        inflight = len(inflight_requests)
+    if isinstance(wsgi_server, AsyncServer):
+        inflight += len(wsgi_server.inflight)
+    registry = file_registry.stats()
+    
+    gauges = [
+        ('metadata_active_jobs', {}, active_jobs),
+        ('metadata_inflight_requests', {}, inflight),
+        ('metadata_registry_files', {}, registry['files']),
+        ('metadata_registry_bytes', {}, registry['bytes']),
+        ('metadata_registry_reserved_bytes', {}, registry['reserved_bytes']),
+        ('metadata_tag_pool_pending', {}, tag_pending)
+    ]
+    if source_cache is not None:
+        gauges.append(('metadata_cache_bytes', {'cache': 'source'}, source_cache.report()['bytes']))
+    if output_cache is not None:
+        gauges.append(('metadata_cache_bytes', {'cache': 'output'}, output_cache.report()['bytes']))
+    if cover_cache is not None:
+        report = cover_cache.report()
+        gauges.append(('metadata_cache_bytes', {'cache': 'cover_memory'}, report['memory_bytes']))
+        gauges.append(('metadata_cache_bytes', {'cache': 'cover_disk'}, report['disk_bytes']))
+    return gauges
+
+def server_status():
+    """服务器状态与各缓存的统计"""
+    return {
+        'status': 'success',
+        'message': '服务器运行正常',
+        'registry': file_registry.stats(),
+        'coalesced_requests': coalesced_requests,
+        'http_pool': get_http_pool_stats(),
+        'tag_pool': get_tag_pool_stats(),
+        'tag_saves': dict(tag_saves),
+        'source_cache': source_cache.report() if source_cache else None,
+        'output_cache': output_cache.report() if output_cache else None,
+        'cover_cache': cover_cache.report() if cover_cache else None
+    }
 
 @app.route('/')
 def index():
@@ -597,14 +3119,99 @@ def index():
         'endpoints': {
             'process_music': 'POST /process-music',
             'download': 'GET /download/<file_id>',
+            'process_batch': 'POST /process-batch',
+            'job_status': 'GET /jobs/<job_id>',
             'status': 'GET /status',
+            'metrics': 'GET /metrics',
+            'profiles': 'GET /debug/profiles',
             'shutdown': 'POST /shutdown'
         }
     })
 
-def init_app(cache_dir=None):
+def load_config(config_path=None):
+    """读取config.json配置"""
+    config_path = config_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+    if not os.path.exists(config_path):
+        return {}
+    try:
+        with open(config_path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"读取配置文件失败: {e}")
+        return {}
+
+def apply_settings(settings):
+    """应用配置中的服务器参数"""
+    global JOB_WORKERS, JOB_QUEUE_SIZE, job_executor, COVER_TIMEOUT, BATCH_WORKERS, batch_executor, FILE_CLEANUP_TIME
+    global OUTPUT_MAX_BYTES, OUTPUT_RESERVE_BYTES, REGISTRY_BACKEND
+    global HTTP_POOL_HOSTS, HTTP_POOL_SIZE, HTTP_HOST_POOL_SIZES, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, http_session
+    global DOWNLOAD_SEGMENTS, DOWNLOAD_SEGMENT_MIN_BYTES, DOWNLOAD_RETRIES
+    global SOURCE_CACHE_MAX_BYTES, COVER_CACHE_MEMORY_BYTES, COVER_CACHE_DISK_BYTES, COVER_CACHE_TTL, COVER_MAX_SIZE, COVER_QUALITY
+    global OUTPUT_CACHE_MAX_BYTES, OUTPUT_CACHE_TTL
+    global SERVER_MODE, SERVER_WORKERS, SERVER_THREADS, DRAIN_TIMEOUT, ASYNC_MAX_CONNECTIONS, TAG_PROCESSES, TAG_PADDING
+    global PROFILE_THRESHOLD, PROFILE_SAMPLE_RATE, PROFILE_KEEP, PROFILE_INTERVAL
+    settings = settings or {}
+    
+    SERVER_MODE = settings.get('server_mode', SERVER_MODE)
+    SERVER_WORKERS = max(1, int(settings.get('server_workers', SERVER_WORKERS)))
+    SERVER_THREADS = max(1, int(settings.get('server_threads', SERVER_THREADS)))
+    DRAIN_TIMEOUT = max(0, float(settings.get('drain_timeout', DRAIN_TIMEOUT)))
+    ASYNC_MAX_CONNECTIONS = max(1, int(settings.get('async_max_connections', ASYNC_MAX_CONNECTIONS)))
+    
+    FILE_CLEANUP_TIME = max(1, float(settings.get('file_cleanup_time', FILE_CLEANUP_TIME)))
+    OUTPUT_MAX_BYTES = int(float(settings.get('output_max_mb', OUTPUT_MAX_BYTES / 1024 / 1024)) * 1024 * 1024)
+    OUTPUT_RESERVE_BYTES = int(float(settings.get('output_reserve_mb', OUTPUT_RESERVE_BYTES / 1024 / 1024)) * 1024 * 1024)
+    if OUTPUT_MAX_BYTES > 0:
+        OUTPUT_RESERVE_BYTES = min(OUTPUT_RESERVE_BYTES, OUTPUT_MAX_BYTES)
+    REGISTRY_BACKEND = settings.get('registry_backend', REGISTRY_BACKEND)
+    JOB_WORKERS = max(1, int(settings.get('job_workers', JOB_WORKERS)))
+    JOB_QUEUE_SIZE = max(0, int(settings.get('job_queue_size', JOB_QUEUE_SIZE)))
+    COVER_TIMEOUT = float(settings.get('cover_timeout', COVER_TIMEOUT))
+    COVER_CACHE_MEMORY_BYTES = int(float(settings.get('cover_cache_memory_mb', COVER_CACHE_MEMORY_BYTES / 1024 / 1024)) * 1024 * 1024)
+    COVER_CACHE_DISK_BYTES = int(float(settings.get('cover_cache_disk_mb', COVER_CACHE_DISK_BYTES / 1024 / 1024)) * 1024 * 1024)
+    COVER_CACHE_TTL = float(settings.get('cover_cache_ttl', COVER_CACHE_TTL))
+    COVER_MAX_SIZE = max(0, int(settings.get('cover_max_size', COVER_MAX_SIZE)))
+    COVER_QUALITY = min(95, max(1, int(settings.get('cover_quality', COVER_QUALITY))))
+    
+    HTTP_POOL_HOSTS = max(1, int(settings.get('http_pool_hosts', HTTP_POOL_HOSTS)))
+    HTTP_POOL_SIZE = max(1, int(settings.get('http_pool_size', HTTP_POOL_SIZE)))
+    HTTP_HOST_POOL_SIZES = dict(settings.get('http_host_pool_sizes', HTTP_HOST_POOL_SIZES))
+    HTTP_CONNECT_TIMEOUT = float(settings.get('http_connect_timeout', HTTP_CONNECT_TIMEOUT))
+    HTTP_READ_TIMEOUT = float(settings.get('http_read_timeout', HTTP_READ_TIMEOUT))
+    DOWNLOAD_SEGMENTS = max(1, int(settings.get('download_segments', DOWNLOAD_SEGMENTS)))
+    DOWNLOAD_SEGMENT_MIN_BYTES = int(float(settings.get('download_segment_min_mb', DOWNLOAD_SEGMENT_MIN_BYTES / 1024 / 1024)) * 1024 * 1024)
+    DOWNLOAD_RETRIES = max(0, int(settings.get('download_retries', DOWNLOAD_RETRIES)))
+    SOURCE_CACHE_MAX_BYTES = int(float(settings.get('source_cache_max_mb', SOURCE_CACHE_MAX_BYTES / 1024 / 1024)) * 1024 * 1024)
+    OUTPUT_CACHE_MAX_BYTES = int(float(settings.get('output_cache_mb', OUTPUT_CACHE_MAX_BYTES / 1024 / 1024)) * 1024 * 1024)
+    OUTPUT_CACHE_TTL = float(settings.get('output_cache_ttl', OUTPUT_CACHE_TTL))
+    
+    # 连接池参数可能已变化，下次请求时重新创建会话
+    with http_session_lock:
+        if http_session is not None:
+            http_session.close()
+            http_session = None
+    
+    BATCH_WORKERS = max(1, int(settings.get('batch_workers', BATCH_WORKERS)))
+    TAG_PROCESSES = max(0, int(settings.get('tag_processes', TAG_PROCESSES)))
+    TAG_PADDING = max(0, int(float(settings.get('tag_padding_kb', TAG_PADDING / 1024)) * 1024))
+    PROFILE_THRESHOLD = max(0, float(settings.get('profile_threshold', PROFILE_THRESHOLD)))
+    PROFILE_SAMPLE_RATE = max(0, int(settings.get('profile_sample_rate', PROFILE_SAMPLE_RATE)))
+    PROFILE_KEEP = max(1, int(settings.get('profile_keep', PROFILE_KEEP)))
+    PROFILE_INTERVAL = max(0.001, float(settings.get('profile_interval_ms', PROFILE_INTERVAL * 1000)) / 1000)
+    
+    # 线程数变化后重新创建线程池
+    if job_executor is not None and job_executor._max_workers != JOB_WORKERS:
+        job_executor.shutdown(wait=False)
+        job_executor = None
+    if batch_executor is not None and batch_executor._max_workers != BATCH_WORKERS:
+        batch_executor.shutdown(wait=False)
+        batch_executor = None
+    if tag_pool is not None and (tag_pool._max_workers != TAG_PROCESSES or tag_pool._initargs[1] != TAG_PADDING):
+        shutdown_tag_pool()
+
+def init_app(cache_dir=None, settings=None):
     """初始化应用程序"""
-    global TEMP_DIR, logger
+    global TEMP_DIR, logger, source_cache, cover_cache, output_cache, file_registry, profiler
     
     # 设置缓存目录
     if cache_dir and os.path.exists(cache_dir):
@@ -625,6 +3232,49 @@ def init_app(cache_dir=None):
     )
     logger = logging.getLogger(__name__)
     
+    apply_settings(settings)
+    
+    # 文件注册表，启动时清理遗留文件
+    file_registry = create_file_registry()
+    cleanup_orphan_files()
+    
+    # 由前置服务器（nginx/Apache）通过X-Sendfile发送文件
+    app.config['USE_X_SENDFILE'] = bool((settings or {}).get('use_x_sendfile', False))
+    
+    # 源音频缓存
+    if SOURCE_CACHE_MAX_BYTES > 0:
+        source_cache = SourceCache(os.path.join(TEMP_DIR, 'source_cache'), SOURCE_CACHE_MAX_BYTES)
+    else:
+        source_cache = None
+    
+    # 性能分析
+    if profiler is not None:
+        profiler.stop()
+    if PROFILE_THRESHOLD > 0 or PROFILE_SAMPLE_RATE > 0:
+        profiler = RequestProfiler(os.path.join(TEMP_DIR, 'profiles'), PROFILE_THRESHOLD,
+                                   PROFILE_SAMPLE_RATE, PROFILE_KEEP, PROFILE_INTERVAL)
+    else:
+        profiler = None
+    
+    # 处理结果缓存
+    if OUTPUT_CACHE_MAX_BYTES > 0:
+        output_cache = OutputCache(os.path.join(TEMP_DIR, 'output_cache'), OUTPUT_CACHE_MAX_BYTES, OUTPUT_CACHE_TTL)
+        if source_cache is None:
+            logger.warning("结果缓存需要源文件缓存提供的ETag/Last-Modified来验证上游内容，未启用源文件缓存时不会命中")
+    else:
+        output_cache = None
+    
+    # 封面缓存
+    if COVER_CACHE_MEMORY_BYTES > 0:
+        cover_cache = CoverCache(
+            COVER_CACHE_MEMORY_BYTES,
+            os.path.join(TEMP_DIR, 'cover_cache'),
+            COVER_CACHE_DISK_BYTES,
+            COVER_CACHE_TTL
+        )
+    else:
+        cover_cache = None
+    
     # 启动清理线程
     cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
     cleanup_thread.start()
@@ -632,12 +3282,591 @@ def init_app(cache_dir=None):
     logger.info("应用程序初始化完成")
     return app
 
-def run_server(host='127.0.0.1', port=5000, cache_dir=None):
-    """运行服务器"""
-    init_app(cache_dir)
+if aiohttp is not None:
+    class PreparedFileResponse(web.FileResponse):
+        """可以在处理函数中提前发送的FileResponse，之后aiohttp再次调用prepare时不重复发送；
+        指定content_etag时用它代替aiohttp按修改时间和大小生成的ETag"""
+        def __init__(self, *args, content_etag=None, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.content_etag = content_etag
+        
+        @property
+        def etag(self):
+            return web.StreamResponse.etag.fget(self)
+        
+        @etag.setter
+        def etag(self, value):
+            web.StreamResponse.etag.fset(self, self.content_etag or value)
+        
+        async def prepare(self, request):
+            if self.prepared:
+                return None
+            return await super().prepare(request)
+
+class AsyncServer:
+    """基于asyncio的服务器：上游下载和文件发送在事件循环中进行，写入标签、哈希等阻塞操作交给线程池"""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.stopped = None
+        self.session = None
+        self.job_slots = None  # 同时执行的异步任务数与job_workers一致
+        self.inflight = {}  # 键 -> asyncio.Future，相同的下载或处理同时只进行一次
+    
+    def close(self):
+        """从其他线程关闭服务器"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+    
+    def run(self):
+        asyncio.run(self._serve())
+    
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_MAX_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+            headers={'User-Agent': HTTP_USER_AGENT},
+            auto_decompress=False
+        )
+        self.job_slots = asyncio.Semaphore(JOB_WORKERS)
+        
+        server_app = web.Application()
+        server_app.on_response_prepare.append(self._add_cors_headers)
+        server_app.router.add_route('*', '/process-music', self.process_music)
+        server_app.router.add_get('/download/{file_id}', self.download)
+        server_app.router.add_get('/jobs/{job_id}', self.job_status)
+        server_app.router.add_get('/status', self.status)
+        server_app.router.add_get('/metrics', self.metrics_endpoint)
+        server_app.router.add_post('/shutdown', self.shutdown)
+        
+        runner = web.AppRunner(server_app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+            await self.stopped.wait()
+        finally:
+            await runner.cleanup()
+            await self.session.close()
+    
+    @staticmethod
+    async def run_blocking(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+    
+    async def single_flight(self, key, factory):
+        """相同的键同时只执行一次，其余调用等待并共用结果"""
+        global coalesced_requests
+        future = self.inflight.get(key)
+        if future is not None:
+            if key[0] == 'track':
+                coalesced_requests += 1
+                metrics.inc('metadata_coalesced_requests_total')
+            return await asyncio.shield(future)
+        
+        future = self.inflight[key] = self.loop.create_future()
+        try:
+            result = await factory()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 没有其他等待者时不报告未取回的异常
+            raise
+        finally:
+            self.inflight.pop(key, None)
+    
+    @staticmethod
+    async def _add_cors_headers(request, response):
+        response.headers['Access-Control-Allow-Origin'] = '*'
+    
+    async def download_source(self, url, file_path, revalidate=True):
+        """异步下载源音频，启用缓存时先做条件请求"""
+        headers = dict(DOWNLOAD_HEADERS)
+        entry = source_cache.revalidation_headers(url, headers) if source_cache is not None and revalidate else None
+        
+        # 分段下载使用线程中的同步连接池
+        if entry is None and DOWNLOAD_SEGMENTS > 1:
+            head = await self.run_blocking(try_segmented_download, url, file_path)
+            if head is not None:
+                if source_cache is not None:
+                    digest = await self.run_blocking(file_sha256, file_path)
+                    await self.run_blocking(source_cache.record, url, head, file_path, digest, os.path.getsize(file_path))
+                return
+        
+        logger.info(f"开始下载: {url}")
+        start = time.perf_counter()
+        async with self.session.get(url, headers=headers) as response:
+            metrics.observe_stage('connect', time.perf_counter() - start, format_label(url))
+            if response.status == 304 and entry:
+                if await self.run_blocking(source_cache.restore, entry['hash'], file_path):
+                    logger.info(f"源文件缓存命中: {url}")
+                    return
+                # 缓存文件已被淘汰，重新完整下载
+                return await self.download_source(url, file_path, revalidate=False)
+            
+            response.raise_for_status()
+            hasher = hashlib.sha256()
+            size = 0
+            with open(file_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+        metrics.inc('metadata_bytes_in_total', size, kind='audio')
+        logger.info(f"下载完成: {file_path}, 文件大小: {size} bytes")
+        
+        if source_cache is not None:
+            await self.run_blocking(source_cache.record, url, response, file_path, hasher.hexdigest(), size)
+    
+    async def fetch_cover(self, cover_url):
+        """异步下载封面，失败时返回None"""
+        if cover_cache is not None:
+            data = await self.run_blocking(cover_cache.lookup, cover_url)
+            if data is not None:
+                return await self.run_blocking(normalize_cover, data)
+        
+        try:
+            logger.info(f"开始下载封面: {cover_url}")
+            with metrics.stage_timer('cover', 'image'):
+                async with self.session.get(cover_url, timeout=aiohttp.ClientTimeout(total=COVER_TIMEOUT)) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+            logger.info("封面下载成功")
+            metrics.inc('metadata_bytes_in_total', len(data), kind='cover')
+        except Exception as e:
+            logger.error(f"封面下载失败: {e}")
+            return None
+        
+        if cover_cache is not None:
+            await self.run_blocking(cover_cache.put, cover_url, data)
+        return await self.run_blocking(normalize_cover, data)
+    
+    async def process_track(self, task, progress=None):
+        """与process_track()相同的流程，网络I/O在事件循环中进行"""
+        progress = progress or _noop_progress
+        if output_cache is not None:
+            file_id = await self.run_blocking(serve_cached_output, task, progress)
+            if file_id:
+                return file_id
+        
+        file_id = str(uuid.uuid4())
+        original_filename = task['filename']
+        file_format = format_label(original_filename)
+        staging_file_path = os.path.join(TEMP_DIR, f"staging_{file_id}_{original_filename}")
+        processed_file_path = os.path.join(TEMP_DIR, f"processed_{file_id}_{original_filename}")
+        
+        reservation = await self.run_blocking(reserve_output_space, OUTPUT_RESERVE_BYTES)
+        registered = False
+        
+        cover_task = None
+        if task.get('cover_url'):
+            progress('cover', 'running')
+            cover_task = asyncio.ensure_future(
+                self.single_flight(('cover', task['cover_url']), lambda: self.fetch_cover(task['cover_url']))
+            )
+        else:
+            progress('cover', 'skipped')
+        
+        try:
+            progress('download', 'running')
+            try:
+                with metrics.stage_timer('download', file_format):
+                    await self.download_source(task['url'], staging_file_path)
+            except Exception as e:
+                logger.error(f"下载失败: {e}")
+                progress('download', 'failed')
+                raise ProcessingError('音乐文件下载失败')
+            
+            if not os.path.exists(staging_file_path) or os.path.getsize(staging_file_path) == 0:
+                progress('download', 'failed')
+                raise ProcessingError('下载的文件无效')
+            progress('download', 'done')
+            source_hash = await self.run_blocking(file_sha256, staging_file_path) if output_cache is not None else None
+            
+            file_registry.release(reservation)
+            reservation = None
+            reservation = await self.run_blocking(reserve_output_space, os.path.getsize(staging_file_path))
+            
+            cover_data = None
+            if cover_task:
+                try:
+                    cover_data = await cover_task
+                except asyncio.CancelledError:
+                    cover_data = None
+                cover_task = None
+                progress('cover', 'done' if cover_data else 'failed')
+            
+            logger.info("开始添加元数据")
+            progress('tagging', 'running')
+            metadata = dict(task['metadata'], cover_data=cover_data)
+            if not await self.run_blocking(tag_file, staging_file_path, metadata):
+                progress('tagging', 'failed')
+                raise ProcessingError('添加元数据失败，可能是不支持的文件格式')
+            progress('tagging', 'done')
+            
+            os.replace(staging_file_path, processed_file_path)
+            info = await self.run_blocking(register_file, file_id, processed_file_path, original_filename, reservation)
+            registered = True
+            
+            if output_cache is not None:
+                try:
+                    await self.run_blocking(output_cache.store, task, source_hash, processed_file_path, info['etag'])
+                except Exception as e:
+                    logger.warning(f"保存结果缓存失败: {e}")
+        
+        finally:
+            if cover_task:
+                cover_task.cancel()
+            if not registered:
+                file_registry.release(reservation)
+            metrics.inc('metadata_tracks_total', format=file_format, result='success' if registered else 'failure')
+            if os.path.exists(staging_file_path):
+                try:
+                    os.remove(staging_file_path)
+                except OSError as e:
+                    logger.warning(f"删除暂存文件失败: {e}")
+        
+        return file_id
+    
+    def process_coalesced(self, task, progress=None):
+        return self.single_flight(('track', task['fingerprint']), lambda: self.process_track(task, progress))
+    
+    async def run_job(self, job):
+        """在事件循环中执行异步任务，超出job_workers的任务排队等待"""
+        async with self.job_slots:
+            await self._run_job(job)
+    
+    async def _run_job(self, job):
+        job['state'] = 'running'
+        job['started_time'] = time.time()
+        try:
+            job['file_id'] = await self.process_coalesced(job['task'], _job_progress(job))
+            job['download_url'] = f"http://{job['host']}/download/{job['file_id']}"
+            job['state'] = 'succeeded'
+            logger.info(f"任务完成: {job['job_id']}")
+        except ProcessingError as e:
+            job['error'] = e.message
+            job['state'] = 'failed'
+            logger.error(f"任务失败: {job['job_id']}, {e.message}")
+        except Exception as e:
+            job['error'] = f'服务器内部错误: {str(e)}'
+            job['state'] = 'failed'
+            logger.error(f"任务执行时发生错误: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            job['finished_time'] = time.time()
+    
+    async def process_music(self, request):
+        """处理音乐文件"""
+        if is_shutting_down:
+            return web.json_response({'error': '服务器正在关闭'}, status=503)
+        if request.method == 'OPTIONS':
+            return web.json_response({'status': 'ok'})
+        
+        try:
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+            logger.info(f"收到请求")
+            
+            task = parse_process_request(data)
+            mode = request.query.get('mode') or data.get('mode', 'sync')
+            if mode == 'stream':
+                raise ProcessingError('asyncio模式不支持流式处理', 400)
+            
+            # 异步模式：任务直接在事件循环中执行，不占用线程
+            if mode == 'async':
+                if not file_registry.has_room(OUTPUT_RESERVE_BYTES):
+                    raise QuotaExceededError()
+                job_id = submit_job(task, request.host, lambda job: asyncio.ensure_future(self.run_job(job)))
+                if job_id is None:
+                    return web.json_response({'error': '任务队列已满，请稍后重试'}, status=503)
+                return web.json_response({
+                    'success': True,
+                    'job_id': job_id,
+                    'status_url': f"http://{request.host}/jobs/{job_id}",
+                    'message': '任务已提交'
+                }, status=202)
+            
+            file_id = await self.process_coalesced(task)
+            return web.json_response({
+                'success': True,
+                'download_url': f"http://{request.host}/download/{file_id}",
+                'file_id': file_id,
+                'message': '文件处理成功'
+            })
+        
+        except ProcessingError as e:
+            return web.json_response({'error': e.message}, status=e.status_code, headers=e.headers)
+        
+        except Exception as e:
+            logger.error(f"处理请求时发生错误: {e}")
+            logger.error(traceback.format_exc())
+            return web.json_response({'error': f'服务器内部错误: {str(e)}'}, status=500)
+    
+    async def download(self, request):
+        """下载文件，单段Range和条件请求由aiohttp处理，多段Range返回multipart/byteranges"""
+        start = time.perf_counter()
+        file_info = await self.run_blocking(file_registry.touch, request.match_info['file_id'])
+        if file_info is None or not os.path.exists(file_info['path']):
+            return web.json_response({'error': '文件不存在或已过期'}, status=404)
+        
+        download_name = f"processed_{file_info['filename']}"
+        etag = file_info.get('etag')
+        if etag:
+            # 与线程模式一致，条件请求按内容ETag判断；aiohttp只认识自己生成的ETag，判断后去掉这些请求头
+            if request.if_none_match and any(tag.value in (etag, '*') for tag in request.if_none_match):
+                return web.Response(status=304, headers={'ETag': f'"{etag}"'})
+            headers = request.headers.copy()
+            for name in ('If-None-Match', 'If-Match', 'If-Unmodified-Since'):
+                headers.popall(name, None)
+            if 'If-None-Match' in request.headers:
+                headers.popall('If-Modified-Since', None)
+            if_range = headers.get('If-Range', '')
+            if if_range.startswith(('"', 'W/')):
+                headers.popall('If-Range')
+                if if_range != f'"{etag}"':
+                    headers.popall('Range', None)
+            
+            # aiohttp的FileResponse只支持单段Range，多段时与线程模式一样自行返回
+            byte_range = parse_range_header(headers.get('Range'))
+            if byte_range is not None and len(byte_range.ranges) > 1:
+                if_range = parse_if_range_header(headers.get('If-Range'))
+                if await self.run_blocking(if_range_matches, if_range, etag, file_info['path']):
+                    return await self.send_multirange(request, file_info, byte_range, etag, download_name, start)
+                # 文件在If-Range的时间之后修改过，返回完整内容
+                headers.popall('Range')
+                headers.popall('If-Range', None)
+            request = request.clone(headers=headers)
+        
+        response = PreparedFileResponse(file_info['path'], chunk_size=STREAM_CHUNK_SIZE, content_etag=etag, headers={
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+            'Content-Type': mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        })
+        # 在此发送文件，以便记录发送耗时
+        await response.prepare(request)
+        file_format = format_label(file_info['filename'])
+        metrics.observe_stage('serve', time.perf_counter() - start, file_format)
+        metrics.inc('metadata_bytes_out_total', response.content_length or 0, format=file_format)
+        return response
+    
+    async def send_multirange(self, request, file_info, byte_range, etag, download_name, start):
+        """按RFC 7233返回多段Range响应，分段和内容与线程模式的send_multirange相同"""
+        file_path = file_info['path']
+        stat = await self.run_blocking(os.stat, file_path)
+        length = stat.st_size
+        ranges = satisfiable_ranges(byte_range, length)
+        if not ranges:
+            return web.Response(status=416, headers={'Content-Range': f'bytes */{length}'})
+        if len(ranges) > MAX_DOWNLOAD_RANGES:
+            return web.json_response({'error': 'Range段数过多'}, status=416,
+                                     headers={'Content-Range': f'bytes */{length}'})
+        
+        mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        boundary, content_length, chunks = multipart_body(file_path, ranges, length, mimetype)
+        response = web.StreamResponse(status=206, headers={
+            'Content-Type': f'multipart/byteranges; boundary={boundary}',
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"
+        })
+        response.content_length = content_length
+        response.etag = etag
+        response.last_modified = int(stat.st_mtime)
+        await response.prepare(request)
+        file_format = format_label(file_info['filename'])
+        metrics.observe_stage('serve', time.perf_counter() - start, file_format)
+        metrics.inc('metadata_bytes_out_total', content_length, format=file_format)
+        
+        # 读文件在线程池中进行，不阻塞事件循环
+        try:
+            while True:
+                chunk = await self.run_blocking(next, chunks, None)
+                if chunk is None:
+                    break
+                await response.write(chunk)
+        finally:
+            chunks.close()
+        await response.write_eof()
+        return response
+    
+    async def metrics_endpoint(self, request):
+        """Prometheus文本格式的监控指标"""
+        text = metrics.render(await self.run_blocking(metric_gauges))
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+    
+    async def job_status(self, request):
+        """查询异步任务状态"""
+        job = job_registry.get(request.match_info['job_id'])
+        if job is None:
+            return web.json_response({'error': '任务不存在或已过期'}, status=404)
+        return web.json_response(job_snapshot(job))
+    
+    async def status(self, request):
+        """返回服务器状态"""
+        if is_shutting_down:
+            return web.json_response({'status': 'shutting_down'}, status=503)
+        return web.json_response(await self.run_blocking(server_status))
+    
+    async def shutdown(self, request):
+        """关闭服务器：不再接收新任务，进行中的任务完成后停止"""
+        global is_shutting_down
+        if not is_shutting_down:
+            is_shutting_down = True
+            threading.Thread(target=stop_server, daemon=True).start()
+        return web.json_response({'status': 'shutting_down', 'message': '服务器正在关闭'})
+
+def drain_server(timeout=None):
+    """停止接收新任务，等待排队和进行中的任务完成"""
+    global is_shutting_down
+    is_shutting_down = True
+    deadline = time.time() + (DRAIN_TIMEOUT if timeout is None else timeout)
+    while True:
+        with job_lock:
+            pending = sum(1 for job in job_registry.values() if job['state'] in ('queued', 'running'))
+        with inflight_lock:
+            pending += len(inflight_requests)
+        if isinstance(wsgi_server, AsyncServer):
+            pending += len(wsgi_server.inflight)
+        if not pending:
+            break
+        if time.time() >= deadline:
+            logger.warning(f"等待超时，仍有 {pending} 个任务未完成")
+            break
+        time.sleep(0.2)
+    
+    # 唤醒清理线程使其退出
+    file_registry.wake()
+
+def close_waitress(server):
+    """关闭waitress的监听socket和所有连接（包括空闲的keep-alive连接）并停止工作线程，使run()返回"""
+    from waitress import wasyncore
+
+    trigger = getattr(server, 'trigger', None)
+    if trigger is None:
+        # 多地址监听（MultiSocketServer）没有自己的trigger，close()会关闭全部连接并停止工作线程
+        server.close()
+        return
+    # 连接只能在事件循环线程中关闭，否则循环会一直等到channel_timeout才退出
+    trigger.pull_trigger(lambda: wasyncore.close_all(server._map))
+    # 停止请求工作线程，否则GUI每次重启服务器都会留下一组线程
+    server.task_dispatcher.shutdown()
+
+def stop_server():
+    """平滑关闭服务器"""
+    server = wsgi_server
+    if server is None:
+        # gunicorn工作进程：通知主进程依次关闭所有工作进程，各进程退出前等待任务完成
+        if SERVER_MODE == 'gunicorn':
+            os.kill(os.getppid(), signal.SIGTERM)
+        return
+    
+    logger.info("服务器正在关闭，等待进行中的任务完成")
+    drain_server()
+    if isinstance(server, BaseWSGIServer):
+        server.shutdown()
+    elif isinstance(server, AsyncServer):
+        server.close()
+    else:
+        # waitress：等待正在发送的响应（包括/shutdown本身）完成后再关闭
+        dispatcher = server.task_dispatcher
+        deadline = time.time() + 5
+        while (dispatcher.active_count or dispatcher.queue) and time.time() < deadline:
+            time.sleep(0.05)
+        close_waitress(server)
+    logger.info("服务器已关闭")
+
+def run_gunicorn(host, port, cache_dir, settings):
+    """以多进程方式运行，每个工作进程单独初始化"""
+    from gunicorn.app.base import BaseApplication
+    
+    if SERVER_WORKERS > 1 and REGISTRY_BACKEND != 'sqlite':
+        logger.warning("多进程模式下应使用sqlite注册表，否则其他进程无法下载文件")
+    if SERVER_WORKERS > 1:
+        logger.warning("异步任务状态只保存在处理它的进程中，多进程模式下请使用同步或批量接口")
+    
+    class GunicornServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', SERVER_WORKERS)
+            self.cfg.set('threads', SERVER_THREADS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('graceful_timeout', int(DRAIN_TIMEOUT) + 10)
+            self.cfg.set('post_worker_init', lambda worker: init_app(cache_dir, settings))
+            self.cfg.set('worker_exit', lambda server, worker: drain_server())
+        
+        def load(self):
+            return app
+    
+    GunicornServer().run()
+
+def run_server(host='127.0.0.1', port=5000, cache_dir=None, settings=None):
+    """运行服务器，直到收到关闭请求"""
+    global wsgi_server, is_shutting_down
+    is_shutting_down = False
+    apply_settings(settings)
+    
+    mode = SERVER_MODE
+    if mode == 'gunicorn' and (os.name == 'nt' or threading.current_thread() is not threading.main_thread()):
+        logger.warning("gunicorn只能在Linux/macOS的主线程中运行，改用waitress")
+        mode = 'waitress'
+    if mode == 'gunicorn':
+        try:
+            run_gunicorn(host, port, cache_dir, settings)
+            return
+        except ImportError:
+            logger.warning("未安装gunicorn，改用waitress")
+            mode = 'waitress'
+    
+    if mode == 'asyncio' and aiohttp is None:
+        logger.warning("未安装aiohttp，改用waitress")
+        mode = 'waitress'
+    
+    init_app(cache_dir, settings)
     logger.info(f"服务器启动: http://{host}:{port}")
     logger.info(f"临时目录: {TEMP_DIR}")
-    app.run(host=host, port=port, debug=False)
+    logger.info(f"异步任务线程数: {JOB_WORKERS}, 队列长度: {JOB_QUEUE_SIZE}")
+    
+    if mode == 'asyncio':
+        wsgi_server = AsyncServer(host, port)
+        logger.info(f"服务器模式: asyncio, 上游连接数上限: {ASYNC_MAX_CONNECTIONS}")
+        try:
+            wsgi_server.run()
+        finally:
+            wsgi_server = None
+        return
+    
+    if mode == 'waitress':
+        try:
+            from waitress import create_server
+            wsgi_server = create_server(app, host=host, port=port, threads=SERVER_THREADS)
+        except ImportError:
+            logger.warning("未安装waitress，改用Flask内置服务器")
+            mode = 'development'
+    if mode != 'waitress':
+        wsgi_server = make_server(host, port, app, threaded=True)
+    logger.info(f"服务器模式: {mode}, 请求线程数: {SERVER_THREADS if mode == 'waitress' else '不限'}")
+    
+    try:
+        if mode == 'waitress':
+            wsgi_server.run()
+        else:
+            wsgi_server.serve_forever()
+            wsgi_server.server_close()
+    finally:
+        wsgi_server = None
 
 if __name__ == '__main__':
-    run_server()
\ No newline at end of file
+    multiprocessing.freeze_support()
+    config = load_config()
+    run_server(
+        config.get('host', '127.0.0.1'),
+        int(config.get('port', 5000)),
+        config.get('cache_dir') or None,
+        config
+    )
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+/download 的Range和条件请求：多段Range返回multipart/byteranges，If-Range支持ETag和日期
+各服务器模式分别运行一遍，确认行为一致
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from email.utils import formatdate
+
+import pytest
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+import server_main  # noqa: E402
+
+CONTENT = bytes(range(256)) * 64
+# 线程模式（未安装waitress时为Flask内置服务器）和asyncio模式的行为应一致
+SERVER_MODES = ['waitress', pytest.param('asyncio', marks=pytest.mark.skipif(
+    server_main.aiohttp is None, reason='未安装aiohttp'))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='module', params=SERVER_MODES)
+def server(request, tmp_path_factory):
+    """在后台线程中运行服务器，返回根地址"""
+    port = free_port()
+    settings = {'server_mode': request.param, 'source_cache_max_mb': 0, 'output_cache_mb': 0}
+    thread = threading.Thread(
+        target=server_main.run_server,
+        args=('127.0.0.1', port, str(tmp_path_factory.mktemp('cache')), settings),
+        daemon=True
+    )
+    thread.start()
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{base}/status', timeout=1)
+            break
+        except requests.RequestException:
+            time.sleep(0.1)
+    yield base
+    requests.post(f'{base}/shutdown', timeout=5)
+    thread.join(10)
+
+
+@pytest.fixture
+def download_url(server, tmp_path):
+    """注册一个已处理的文件，返回其下载地址"""
+    file_id = str(uuid.uuid4())
+    path = str(tmp_path / f'processed_{file_id}_track.mp3')
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+    server_main.register_file(file_id, path, 'track.mp3')
+    return f'{server}/download/{file_id}'
+
+
+def multipart_parts(response):
+    """解析multipart/byteranges，返回 [(Content-Range, 内容)]"""
+    content_type = response.headers['Content-Type']
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    boundary = content_type.split('boundary=', 1)[1].encode('ascii')
+    parts = []
+    for part in response.content.split(b'--' + boundary)[1:-1]:
+        headers, body = part.strip(b'\r\n').split(b'\r\n\r\n', 1)
+        content_range = next(line.split(b': ', 1)[1].decode('ascii') for line in headers.split(b'\r\n')
+                             if line.lower().startswith(b'content-range'))
+        parts.append((content_range, body))
+    return parts
+
+
+def expected_parts(*ranges):
+    return [(f'bytes {start}-{end}/{len(CONTENT)}', CONTENT[start:end + 1]) for start, end in ranges]
+
+
+def test_multiple_ranges(download_url):
+    response = requests.get(download_url, headers={'Range': 'bytes=0-9,20-29'})
+
+    assert response.status_code == 206
+    assert multipart_parts(response) == expected_parts((0, 9), (20, 29))
+
+
+def test_multiple_ranges_with_matching_etag_if_range(download_url):
+    etag = requests.get(download_url).headers['ETag']
+
+    response = requests.get(download_url, headers={'Range': 'bytes=0-9,20-29', 'If-Range': etag})
+
+    assert response.status_code == 206
+    assert multipart_parts(response) == expected_parts((0, 9), (20, 29))
+
+
+def test_multiple_ranges_with_stale_etag_if_range(download_url):
+    response = requests.get(download_url, headers={'Range': 'bytes=0-9,20-29', 'If-Range': '"stale"'})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_multiple_ranges_with_last_modified_if_range(download_url):
+    last_modified = requests.get(download_url).headers['Last-Modified']
+
+    response = requests.get(download_url, headers={'Range': 'bytes=0-9,20-29', 'If-Range': last_modified})
+
+    assert response.status_code == 206
+    assert multipart_parts(response) == expected_parts((0, 9), (20, 29))
+
+
+def test_multiple_ranges_with_old_date_if_range(download_url):
+    old_date = formatdate(time.time() - 3600, usegmt=True)
+
+    response = requests.get(download_url, headers={'Range': 'bytes=0-9,20-29', 'If-Range': old_date})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_single_range_with_last_modified_if_range(download_url):
+    last_modified = requests.get(download_url).headers['Last-Modified']
+
+    response = requests.get(download_url, headers={'Range': 'bytes=0-9', 'If-Range': last_modified})
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[:10]
+
+
+def test_too_many_ranges(download_url):
+    ranges = ','.join(f'{i * 10}-{i * 10 + 4}' for i in range(server_main.MAX_DOWNLOAD_RANGES + 1))
+
+    response = requests.get(download_url, headers={'Range': f'bytes={ranges}'})
+
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(CONTENT)}'
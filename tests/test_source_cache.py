@@ -0,0 +1,99 @@
+"""
+源文件缓存：缓存中保存的是独立的副本，写入标签不会影响缓存的源文件
+未命中时源文件写入两次（暂存文件和缓存各一次），命中时只写入一次且不下载内容
+"""
+
+import hashlib
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+import server_main  # noqa: E402
+from fixtures import make_audio  # noqa: E402
+from upstream import StandInUpstream  # noqa: E402
+
+CONTENT = make_audio('flac', 256 * 1024)
+
+# 审计钩子无法移除，只安装一次，通过_watched_dir控制是否统计
+_watched_dir = None
+_written = []
+
+
+def _audit(event, args):
+    if event != 'open' or _watched_dir is None or not isinstance(args[0], (str, bytes, os.PathLike)):
+        return
+    path, mode, flags = args
+    writing = any(c in mode for c in 'wax+') if mode is not None else bool(flags & (os.O_WRONLY | os.O_RDWR))
+    if writing and os.fspath(path).startswith(_watched_dir):
+        _written.append(os.fspath(path))
+
+
+sys.addaudithook(_audit)
+
+
+def fetch_counting_writes(cache, url, file_path, watched_dir):
+    """下载到file_path，返回 (是否成功, 以写模式打开的文件列表)"""
+    global _watched_dir
+    _written.clear()
+    _watched_dir = watched_dir
+    try:
+        ok = cache.fetch(url, file_path)
+    finally:
+        _watched_dir = None
+    # 缓存索引很小，只统计写入音频数据的文件
+    return ok, [path for path in _written if os.path.basename(path) != 'index.json.tmp']
+
+
+@pytest.fixture
+def upstream():
+    server = StandInUpstream({'/track.flac': CONTENT}).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return server_main.SourceCache(str(tmp_path / 'source_cache'), 64 * 1024 * 1024)
+
+
+def test_miss_writes_staging_file_and_cache_copy(cache, upstream, tmp_path):
+    staging = str(tmp_path / 'staging.flac')
+
+    ok, written = fetch_counting_writes(cache, upstream.url('/track.flac'), staging, str(tmp_path))
+
+    assert ok
+    blob = cache.blob_path(hashlib.sha256(CONTENT).hexdigest())
+    # 有意为之：缓存保存独立的副本，源文件在未命中时写入两次
+    assert written[0] == staging
+    assert len(written) == 2 and written[1].startswith(blob)
+    assert not os.path.samefile(blob, staging)
+
+
+def test_tagging_the_staging_file_leaves_the_cache_intact(cache, upstream, tmp_path):
+    staging = str(tmp_path / 'staging.flac')
+    assert cache.fetch(upstream.url('/track.flac'), staging)
+
+    assert server_main.add_metadata_to_file(staging, {'title': '新标题', 'artist': '艺术家'})
+
+    with open(cache.blob_path(hashlib.sha256(CONTENT).hexdigest()), 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_hit_writes_once_without_downloading(cache, upstream, tmp_path):
+    url = upstream.url('/track.flac')
+    assert cache.fetch(url, str(tmp_path / 'first.flac'))
+    requests_before = upstream.requests
+    second = str(tmp_path / 'second.flac')
+
+    ok, written = fetch_counting_writes(cache, url, second, str(tmp_path))
+
+    assert ok
+    assert written == [second]
+    assert upstream.requests == requests_before + 1  # 只有一次返回304的条件请求
+    assert cache.report()['hits'] == 1
+    with open(second, 'rb') as f:
+        assert f.read() == CONTENT
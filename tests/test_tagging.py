@@ -0,0 +1,173 @@
+"""
+标签写入的I/O次数：每种格式只解析一次、只写入一次
+用审计钩子统计对目标文件的open调用，读模式计为解析，写模式计为写入
+"""
+
+import io
+import os
+import sys
+
+import mutagen
+import pytest
+from mutagen.id3 import ID3, TXXX
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+import server_main  # noqa: E402
+from fixtures import FORMATS, make_cover, write_audio  # noqa: E402
+
+AUDIO_SIZE = 256 * 1024
+
+METADATA = {
+    'title': '测试标题',
+    'artist': '测试艺术家',
+    'album': '测试专辑',
+    'year': '2024',
+    'lyrics': '测试歌词',
+    'tips': '测试注释',
+    'cover_data': make_cover(64 * 1024),
+}
+
+# 审计钩子无法移除，只安装一次，通过_watched控制是否统计
+_watched = None
+_opens = []
+
+
+def _audit(event, args):
+    if event == 'open' and _watched is not None and args[0] is not None:
+        if os.fspath(args[0]) == _watched:
+            _opens.append(args)
+
+
+sys.addaudithook(_audit)
+
+
+def _is_write(args):
+    path, mode, flags = args
+    if mode is not None:
+        return any(c in mode for c in 'wax+')
+    return bool(flags & (os.O_WRONLY | os.O_RDWR))
+
+
+def count_opens(function, path):
+    """调用function(path)，返回 (结果, 读模式打开次数, 写模式打开次数)"""
+    global _watched
+    _opens.clear()
+    _watched = path
+    try:
+        result = function(path)
+    finally:
+        _watched = None
+    writes = sum(1 for args in _opens if _is_write(args))
+    return result, len(_opens) - writes, writes
+
+
+def id3v1_tag(title):
+    """128字节的ID3v1标签"""
+    return b'TAG' + title.ljust(30, b'\x00') + b'\x00' * 92 + b'\xff'
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+    def build(name):
+        path = str(tmp_path / f'track{FORMATS[name][0]}')
+        write_audio(path, name, AUDIO_SIZE)
+        return path
+    return build
+
+
+@pytest.mark.parametrize('name', list(FORMATS))
+def test_add_metadata_parses_and_writes_once(audio_file, name):
+    path = audio_file(name)
+
+    ok, parses, writes = count_opens(lambda p: server_main.add_metadata_to_file(p, METADATA), path)
+
+    assert ok
+    assert parses == 1
+    assert writes == 1
+    tags = mutagen.File(path)
+    assert tags is not None and tags.tags is not None
+
+
+@pytest.mark.parametrize('name', list(FORMATS))
+def test_retag_parses_and_writes_once(audio_file, name):
+    path = audio_file(name)
+    assert server_main.add_metadata_to_file(path, METADATA)
+
+    ok, parses, writes = count_opens(lambda p: server_main.add_metadata_to_file(p, dict(METADATA, title='新标题')), path)
+
+    assert ok
+    assert (parses, writes) == (1, 1)
+
+
+def test_mp3_with_id3v2_and_id3v1_writes_once(tmp_path):
+    path = str(tmp_path / 'track.mp3')
+    with open(path, 'wb') as f:
+        for chunk in FORMATS['mp3'][1](AUDIO_SIZE, old_tags=True):
+            f.write(chunk)
+        f.write(id3v1_tag(b'old v1 title'))
+    assert mutagen.File(path).tags.getall('TIT2')[0].text == ['旧标题']
+
+    ok, parses, writes = count_opens(lambda p: server_main.add_metadata_to_file(p, METADATA), path)
+
+    assert ok
+    assert (parses, writes) == (1, 1)
+    # ID3v1在同一次写入中被删除，ID3v2只包含新的标签
+    with open(path, 'rb') as f:
+        f.seek(-128, os.SEEK_END)
+        assert f.read(3) != b'TAG'
+    tags = mutagen.File(path).tags
+    assert tags.getall('TIT2')[0].text == [METADATA['title']]
+    assert tags.getall('TPE1')[0].text == [METADATA['artist']]
+    assert len(tags.getall('APIC')) == 1
+
+
+@pytest.mark.parametrize('name', list(FORMATS))
+def test_strip_existing_metadata_writes_once(audio_file, name):
+    path = audio_file(name)
+    assert server_main.add_metadata_to_file(path, METADATA)
+
+    ok, parses, writes = count_opens(server_main.strip_existing_metadata, path)
+
+    assert ok
+    assert writes == 1
+    assert parses <= 1
+
+
+
+def id3v2_prefix(payload_size):
+    """带一个TXXX帧的ID3v2标签，用于放在FLAC文件头之前"""
+    tags = ID3()
+    tags.add(TXXX(encoding=3, desc='prefix', text='x' * payload_size))
+    buffer = io.BytesIO()
+    tags.save(buffer, padding=lambda info: 0)
+    return buffer.getvalue()
+
+
+def audio_offset(path):
+    """FLAC音频帧的起始位置（fixtures生成的第一帧以同步码0xFFF8开头）"""
+    with open(path, 'rb') as f:
+        return f.read().index(b'\xff\xf8', 4)
+
+
+@pytest.mark.parametrize('prefix_size, expected_mode', [(1024, 'in_place'), (1024 * 1024, 'rewrite')])
+def test_flac_with_id3_prefix_reports_save_mode(tmp_path, prefix_size, expected_mode):
+    path = str(tmp_path / 'track.flac')
+    write_audio(path, 'flac', AUDIO_SIZE)
+    assert server_main.add_metadata_to_file(path, METADATA)  # 先写入一次，留出填充
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(id3v2_prefix(prefix_size) + data)
+    offset = audio_offset(path)
+
+    ok, _, _, mode = server_main._tag_with_timings(path, dict(METADATA, title='新标题'))
+
+    assert ok
+    with open(path, 'rb') as f:
+        assert f.read(4) == b'fLaC'
+    # 去掉ID3前缀时mutagen把它占用的空间并入填充：原地更新时音频位置不变，否则音频被移动
+    assert mode == expected_mode
+    assert (audio_offset(path) == offset) == (expected_mode == 'in_place')
+    assert mutagen.File(path).tags['title'] == ['新标题']